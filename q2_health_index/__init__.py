@@ -6,10 +6,18 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from ._gmhi import gmhi_predict, gmhi_predict_viz
+from ._async_batch import gmhi_from_qzas, iter_gmhi_from_qzas
+from ._gmhi import (calculate_gmhi, calculate_gmhi_batch, gmhi_from_qza,
+                    gmhi_predict, gmhi_predict_viz)
+from ._metaphlan import (calculate_gmhi_metaphlan,
+                         calculate_gmhi_metaphlan_profiles)
+from ._scorer import GMHIScorer
 from ._version import get_versions
 
 __version__ = get_versions()['version']
 del get_versions
 
-__all__ = ['calculate_gmhi', 'calculate_gmhi_viz']
+__all__ = ['GMHIScorer', 'calculate_gmhi', 'calculate_gmhi_batch',
+           'calculate_gmhi_metaphlan', 'calculate_gmhi_metaphlan_profiles',
+           'gmhi_from_qza', 'gmhi_from_qzas', 'gmhi_predict',
+           'gmhi_predict_viz', 'iter_gmhi_from_qzas']
@@ -0,0 +1,177 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import asyncio
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from q2_health_index._qza import _extract_qza_biom, _open_qza_biom
+from q2_health_index._scorer import GMHIScorer
+
+# Marks the end of a stage's output in the queues
+_DONE = object()
+
+READ_AHEAD_BLOCK_SIZE = 1 << 22
+
+
+def _read_ahead(table_fp: str = None):
+    """
+    Read a file sequentially, discarding the data, so that it is in the
+    page cache by the time it is scored
+    """
+    with open(table_fp, 'rb', buffering=0) as fh:
+        while fh.read(READ_AHEAD_BLOCK_SIZE):
+            pass
+
+
+def _load_qza(table_fp: str = None, tmp_dir: str = None):
+    """
+    Validate an archive and make its payload ready for scoring, returning
+    (payload directory, payload path)
+
+    Deflated payloads are inflated into a directory of their own in
+    `tmp_dir`, stored ones are read ahead and later read in place (the
+    payload path is then None).
+    """
+    payload_dir = tempfile.mkdtemp(dir=tmp_dir)
+    payload_fp = _extract_qza_biom(table_fp, payload_dir)
+    if payload_fp is None:
+        _read_ahead(table_fp)
+    return payload_dir, payload_fp
+
+
+def _score_qza(scorer: GMHIScorer = None, table_fp: str = None,
+               payload_fp: str = None):
+    # Payloads are passed as paths and only the marker features are read,
+    # so the payload itself never has to be sent to the workers
+    if payload_fp is not None:
+        return scorer.score_biom_file(payload_fp)
+    with _open_qza_biom(table_fp) as (_, _, payload):
+        return scorer.score_biom_file(payload)
+
+
+def _write_result(output_dir: str = None, table_fp: str = None,
+                  gmhi: pd.Series = None):
+    name = os.path.basename(table_fp)
+    if name.endswith('.qza'):
+        name = name[:-len('.qza')]
+    gmhi.to_csv(os.path.join(output_dir, f'{name}.tsv'), sep='\t',
+                index_label='sample-id')
+
+
+async def iter_gmhi_from_qzas(table_fps: list = None,
+                              scorer: GMHIScorer = None,
+                              max_concurrency: int = 4,
+                              n_jobs: int = 1,
+                              output_dir: str = None):
+    """
+    Calculate GMHI of many feature table .qza files, overlapping reading
+    and inflating the archives with scoring them, and yield (path, GMHI)
+    of every table as soon as it is scored (not in the input order)
+
+    Up to `max_concurrency` archives are loaded at once, in threads:
+    deflated payloads are inflated into a temporary directory, stored ones
+    are read ahead into the page cache. At most `max_concurrency` loaded
+    archives wait for scoring, so loading stops when scoring falls behind
+    and at most 2 x `max_concurrency` + `n_jobs` inflated payloads are on
+    disk at once. Archives are scored in a pool of `n_jobs` processes,
+    which read only the marker features of the payloads. If `output_dir`
+    is provided, every result is written there as <table name>.tsv as soon
+    as it is scored.
+    """
+    scorer = scorer or GMHIScorer()
+    loop = asyncio.get_running_loop()
+    table_fps = iter(table_fps)
+    # Bounded, so that reading does not run too far ahead of scoring
+    loaded = asyncio.Queue(maxsize=max_concurrency)
+    scored = asyncio.Queue()
+
+    async def guard(coroutine):
+        # Errors of any stage are raised to the consumer, which then
+        # cancels the rest
+        try:
+            await coroutine
+        except Exception as error:
+            await scored.put(error)
+
+    async def load(tmp_dir):
+        # Loaders share the iterator, every path is loaded once
+        for table_fp in table_fps:
+            payload = await loop.run_in_executor(None, _load_qza, table_fp,
+                                                 tmp_dir)
+            await loaded.put((table_fp, *payload))
+
+    async def score(executor):
+        while True:
+            item = await loaded.get()
+            if item is _DONE:
+                return
+            table_fp, payload_dir, payload_fp = item
+            try:
+                gmhi = await loop.run_in_executor(executor, _score_qza,
+                                                  scorer, table_fp,
+                                                  payload_fp)
+            finally:
+                await loop.run_in_executor(None, shutil.rmtree, payload_dir)
+            if output_dir:
+                await loop.run_in_executor(None, _write_result, output_dir,
+                                           table_fp, gmhi)
+            await scored.put((table_fp, gmhi))
+
+    async def feed(scorers, tmp_dir):
+        await asyncio.gather(*(guard(load(tmp_dir))
+                               for _ in range(max_concurrency)))
+        for _ in scorers:
+            await loaded.put(_DONE)
+        await asyncio.gather(*scorers)
+        await scored.put(_DONE)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        scorers = [asyncio.ensure_future(guard(score(executor)))
+                   for _ in range(n_jobs)]
+        tasks = scorers + [asyncio.ensure_future(feed(scorers, tmp_dir))]
+        try:
+            while True:
+                item = await scored.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _collect(table_fps: list = None, **kwargs):
+    return {table_fp: gmhi async for table_fp, gmhi
+            in iter_gmhi_from_qzas(table_fps, **kwargs)}
+
+
+def gmhi_from_qzas(table_fps: list = None,
+                   scorer: GMHIScorer = None,
+                   max_concurrency: int = 4,
+                   n_jobs: int = 1,
+                   output_dir: str = None) -> dict:
+    """
+    Calculate GMHI of many feature table .qza files concurrently (see
+    `iter_gmhi_from_qzas`), returning {path: GMHI} in the input order
+    """
+    table_fps = list(table_fps)
+    results = asyncio.run(_collect(
+        table_fps, scorer=scorer, max_concurrency=max_concurrency,
+        n_jobs=n_jobs, output_dir=output_dir))
+    return {table_fp: results[table_fp] for table_fp in table_fps}
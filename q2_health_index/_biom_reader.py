@@ -0,0 +1,153 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import h5py
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def _read_ids(biom_file: h5py.File, axis: str = 'sample'):
+    ids = biom_file[f'{axis}/ids'][:]
+    return pd.Index([i.decode('utf8') if isinstance(i, bytes) else i
+                     for i in ids])
+
+
+def _sample_positions(biom_file: h5py.File, sample_ids: list = None):
+    """
+    Positions (in the file order) of the selected samples present in a
+    BIOM 2.1 file, None if no samples are selected
+    """
+    if sample_ids is None:
+        return None
+    positions = _read_ids(biom_file, 'sample').get_indexer(list(sample_ids))
+    positions = np.unique(positions[positions >= 0])
+    if not len(positions):
+        raise ValueError('None of the selected samples is present in the '
+                         'feature table.')
+    return positions
+
+
+def _iter_sample_blocks(biom_file: h5py.File, chunk_size: int = None,
+                        samples: np.ndarray = None, dtype=np.float64):
+    """
+    Read the sample-major (CSR) matrix of a BIOM 2.1 file in blocks of
+    `chunk_size` samples, yielding (sample ids, samples x features CSR)
+
+    If sample positions are provided, only those samples are read. Values
+    are returned as `dtype`.
+    """
+    sample_ids = _read_ids(biom_file, 'sample')
+    if samples is None:
+        samples = np.arange(len(sample_ids))
+    n_features = len(biom_file['observation/ids'])
+    matrix = biom_file['sample/matrix']
+    indptr = matrix['indptr'][:]
+    chunk_size = chunk_size or max(len(samples), 1)
+
+    for start in range(0, len(samples), chunk_size):
+        block_samples = samples[start:start + chunk_size]
+        yield sample_ids[block_samples], _read_rows(
+            matrix, indptr, block_samples, n_features, dtype)
+
+
+def _read_rows(matrix: h5py.Group, indptr: np.ndarray, rows: np.ndarray,
+               n_columns: int, dtype=np.float64, block_size: int = 2 ** 20):
+    """
+    Read only `rows` of a CSR matrix stored in a BIOM 2.1 file, runs of
+    consecutive rows are read at once, in blocks of `block_size` values
+
+    Values are converted to `dtype` by HDF5 as they are read into the
+    result, so only a block of them is ever held in the dtype of the file,
+    and indices keep the dtype of the file.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    row_indptr = np.concatenate([[0], np.cumsum(indptr[rows + 1] -
+                                                indptr[rows])])
+    data = np.empty(row_indptr[-1], dtype=dtype)
+    indices = np.empty(row_indptr[-1], dtype=matrix['indices'].dtype)
+    # Positions in `rows` where runs of consecutive rows start and end
+    run_starts = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+    run_stops = np.append(run_starts[1:], len(rows))
+    for start, stop in zip(run_starts, run_stops):
+        first, last = indptr[rows[start]], indptr[rows[stop - 1] + 1]
+        offset = row_indptr[start] - first
+        for block in range(first, last, block_size):
+            source = np.s_[block:min(block + block_size, last)]
+            target = np.s_[offset + source.start:offset + source.stop]
+            matrix['data'].read_direct(data, source, target)
+            matrix['indices'].read_direct(indices, source, target)
+    return sparse.csr_matrix((data, indices, row_indptr),
+                             shape=(len(rows), n_columns), copy=False)
+
+
+def _row_sums(matrix: h5py.Group, indptr: np.ndarray, rows: np.ndarray = None,
+              block_size: int = 2 ** 24):
+    """
+    Sum (selected) rows of a CSR matrix stored in a BIOM 2.1 file, reading
+    only the values, in blocks of consecutive rows of about `block_size`
+    values
+    """
+    if rows is None:
+        rows = np.arange(len(indptr) - 1)
+    rows = np.asarray(rows, dtype=np.int64)
+    sums = np.zeros(len(rows))
+    # Positions in `rows` where runs of consecutive rows start and end
+    run_starts = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+    run_stops = np.append(run_starts[1:], len(rows))
+    for start, run_stop in zip(run_starts, run_stops):
+        while start < run_stop:
+            first = rows[start]
+            last = np.searchsorted(indptr, indptr[first] + block_size,
+                                   'right') - 1
+            stop = min(max(start + last - first, start + 1), run_stop)
+            last = first + stop - start
+            offsets = indptr[first:last + 1] - indptr[first]
+            data = matrix['data'][indptr[first]:indptr[last]]
+            # Padding makes offsets of empty trailing rows valid
+            block_sums = np.add.reduceat(np.append(data, 0), offsets[:-1])
+            sums[start:stop] = np.where(np.diff(offsets) > 0, block_sums, 0)
+            start = stop
+    return sums
+
+
+def _read_marker_projection(biom_file: h5py.File, included: np.ndarray,
+                            markers, samples: np.ndarray = None,
+                            dtype=np.float64):
+    """
+    Project a BIOM 2.1 file onto the marker features without loading the
+    whole table
+
+    Marker rows are sliced from the feature-major (observation) matrix and
+    the per-sample totals of the `included` features are the sums of the
+    sample-major values minus the excluded features. `markers` are either
+    marker feature positions or a sparse aggregation matrix (see
+    `_kernel.marker_columns`). If sample positions are provided, only
+    those samples are projected. Returns markers as samples x markers CSR
+    of `dtype` and the totals, which are always summed in float64.
+    """
+    n_samples = len(biom_file['sample/ids'])
+    observations = biom_file['observation/matrix']
+    observation_indptr = observations['indptr'][:]
+
+    def read_features(features, dtype=np.float64):
+        rows = _read_rows(observations, observation_indptr, features,
+                          n_samples, dtype)
+        return rows if samples is None else rows[:, samples]
+
+    if sparse.issparse(markers):
+        features = np.flatnonzero(np.diff(markers.indptr))
+        projected = (markers[features].T.astype(dtype) @
+                     read_features(features, dtype)).T
+    else:
+        projected = read_features(markers, dtype).T
+
+    sample_matrix = biom_file['sample/matrix']
+    totals = _row_sums(sample_matrix, sample_matrix['indptr'][:], samples) - \
+        np.asarray(read_features(np.flatnonzero(~included)).sum(axis=0))[0]
+    return sparse.csr_matrix(projected), totals
@@ -0,0 +1,82 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from q2_health_index._labels import LABEL_INDEX_SUFFIX
+
+CACHE_SUFFIX = '.gmhi.tsv'
+
+# Hit/miss counters of the current process
+_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def _cache_key(table_id: str = None,
+               healthy_species_list: list = None,
+               non_healthy_species_list: list = None,
+               **parameters):
+    """
+    Content address of a GMHI result: the input table UUID (or payload
+    hash), the loaded species lists and the scoring parameters
+    """
+    key = json.dumps({'table': str(table_id),
+                      'healthy_species': sorted(healthy_species_list),
+                      'non_healthy_species': sorted(non_healthy_species_list),
+                      'parameters': parameters}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+def _report(hit: bool):
+    _CACHE_STATS['hits' if hit else 'misses'] += 1
+    print(f'GMHI cache {"hit" if hit else "miss"} '
+          f'(hits: {_CACHE_STATS["hits"]}, misses: {_CACHE_STATS["misses"]})')
+
+
+def _cache_load(cache_dir: str = None, key: str = None):
+    fp = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    try:
+        gmhi = pd.read_csv(fp, sep='\t', index_col=0, header=0,
+                           dtype={'sample-id': str})['GMHI']
+    except (FileNotFoundError, KeyError, ValueError):
+        _report(hit=False)
+        return None
+    # Mark as recently used for the LRU eviction
+    os.utime(fp)
+    gmhi.index.name = None
+    _report(hit=True)
+    return gmhi
+
+
+def _cache_store(cache_dir: str = None, key: str = None,
+                 gmhi: pd.Series = None, max_size: int = 1024):
+    """
+    Store a GMHI result and evict the least recently used results and
+    label indices (see `_label_index`) until the cache fits in `max_size`
+    megabytes
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write atomically, so that concurrent runs never read partial results
+    fd, tmp_fp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        gmhi.rename('GMHI').rename_axis('sample-id').to_csv(fh, sep='\t')
+    os.replace(tmp_fp, os.path.join(cache_dir, key + CACHE_SUFFIX))
+
+    entries = sorted((entry for entry in os.scandir(cache_dir)
+                      if entry.name.endswith((CACHE_SUFFIX,
+                                              LABEL_INDEX_SUFFIX))),
+                     key=lambda entry: entry.stat().st_mtime, reverse=True)
+    total_size = 0
+    for entry in entries:
+        total_size += entry.stat().st_size
+        if total_size > max_size * 1024 ** 2:
+            os.remove(entry.path)
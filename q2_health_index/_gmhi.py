@@ -6,87 +6,222 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
+from concurrent.futures import ProcessPoolExecutor
+
+import biom
 import qiime2
-import numpy as np
 import pandas as pd
 
-from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
-from q2_health_index._utilities import (_load_and_validate_species,
-                                        _load_metadata,
-                                        _validate_metadata_is_superset)
+from q2_types.feature_table import (FeatureTable, Frequency, RelativeFrequency,
+                                    BIOMV210Format)
+from q2_health_index._cache import _cache_key, _cache_load, _cache_store
+from q2_health_index._incremental import _score_incremental
+from q2_health_index._kernel import gmhi_sparse
+from q2_health_index._qza import _open_qza_biom
+from q2_health_index._scorer import GMHIScorer
+from q2_health_index._utilities import (_load_metadata,
+                                        _select_sample_ids,
+                                        _validate_metadata_is_superset,
+                                        _validate_unique_sample_ids)
+
+
+def _calculate_gmhi(table: qiime2.Artifact = None,
+                    healthy_species_fp: str = None,
+                    non_healthy_species_fp: str = None,
+                    mh_prime: int = 7,
+                    mn_prime: int = 31,
+                    rel_thresh: float = 0.00001,
+                    log_thresh: float = 0.00001,
+                    chunk_size: int = None,
+                    n_jobs: int = 1,
+                    cache_dir: str = None,
+                    cache_max_size: int = 1024,
+                    collapse_species: bool = False,
+                    taxonomy: qiime2.Artifact = None,
+                    sample_ids: set = None,
+                    dtype: str = 'float64',
+                    incremental_fp: str = None,
+                    incremental_detect_changes: bool = False):
+    # Load and validate species lists
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh,
+                        collapse_species, dtype, cache_dir)
+
+    # Frequencies are not converted to relative frequencies, because the
+    # marker abundances are re-normalized with per-sample totals of the
+    # classified species anyway (the result is invariant to sample scaling)
+    assert table.type in (FeatureTable[Frequency],
+                          FeatureTable[RelativeFrequency]), \
+        'Feature table not of the type \'Frequency\' or ' \
+        '\'RelativeFrequency\''
+
+    # The results file is the cache of incremental runs, a cache hit would
+    # leave it out of date
+    if cache_dir and not incremental_fp:
+        # Feature IDs are only meaningful together with the taxonomy
+        table_id = table.uuid if taxonomy is None else \
+            f'{table.uuid}:{taxonomy.uuid}'
+        cache_key = _cache_key(table_id, scorer.healthy_species,
+                               scorer.non_healthy_species, mh_prime=mh_prime,
+                               mn_prime=mn_prime, rel_thresh=rel_thresh,
+                               log_thresh=log_thresh,
+                               collapse_species=collapse_species,
+                               dtype=dtype,
+                               samples=sorted(sample_ids)
+                               if sample_ids is not None else None)
+        gmhi_df = _cache_load(cache_dir, cache_key)
+        if gmhi_df is not None:
+            return gmhi_df
+
+    if incremental_fp:
+        # Previous results are reused only if calculated with the same
+        # species lists, parameters and taxonomy
+        fingerprint = _cache_key(None if taxonomy is None else taxonomy.uuid,
+                                 scorer.healthy_species,
+                                 scorer.non_healthy_species,
+                                 mh_prime=mh_prime, mn_prime=mn_prime,
+                                 rel_thresh=rel_thresh, log_thresh=log_thresh,
+                                 collapse_species=collapse_species,
+                                 dtype=dtype)
+
+    if taxonomy is not None:
+        taxonomy = taxonomy.view(pd.Series)
+
+    biom_fp = str(table.view(BIOMV210Format).path)
+    if incremental_fp:
+        # Only new samples (and samples whose abundances changed) are
+        # scored, reusing results for another table without change
+        # detection warns
+        gmhi_df = _score_incremental(scorer, biom_fp, incremental_fp,
+                                     fingerprint, chunk_size, n_jobs,
+                                     taxonomy, sample_ids,
+                                     incremental_detect_changes,
+                                     str(table.uuid))
+    else:
+        # Only the selected samples are read from the biom file, in blocks
+        # of samples if chunked or parallel, otherwise only the marker
+        # features
+        gmhi_df = scorer.score_biom_file(biom_fp, chunk_size, n_jobs,
+                                         taxonomy, sample_ids)
+
+    if cache_dir and not incremental_fp:
+        _cache_store(cache_dir, cache_key, gmhi_df, cache_max_size)
+
+    return gmhi_df
 
 
-def shannon_alpha_div(data):
+def calculate_gmhi(table: biom.Table,
+                   taxonomy: pd.Series = None,
+                   healthy_species_fp: str = None,
+                   non_healthy_species_fp: str = None,
+                   mh_prime: int = 7,
+                   mn_prime: int = 31,
+                   rel_thresh: float = 0.00001,
+                   log_thresh: float = 0.00001,
+                   n_jobs: int = 1,
+                   collapse_species: bool = False,
+                   dtype: str = 'float64') -> pd.Series:
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh,
+                        collapse_species, dtype)
+    return scorer.score_table(table, taxonomy, n_jobs)
+
+
+def calculate_gmhi_batch(tables: biom.Table,
+                         taxonomy: pd.Series = None,
+                         healthy_species_fp: str = None,
+                         non_healthy_species_fp: str = None,
+                         mh_prime: int = 7,
+                         mn_prime: int = 31,
+                         rel_thresh: float = 0.00001,
+                         log_thresh: float = 0.00001,
+                         n_jobs: int = 1,
+                         collapse_species: bool = False,
+                         dtype: str = 'float64') -> pd.Series:
+    # Results are merged, so sample IDs must be unique across the tables
+    _validate_unique_sample_ids([table.ids(axis='sample')
+                                 for table in tables])
+
+    # The panel is compiled once and the labels of tables sharing a
+    # feature space are parsed once
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh,
+                        collapse_species, dtype)
+    if n_jobs == 1 or len(tables) == 1:
+        return pd.concat([scorer.score_table(table, taxonomy, n_jobs)
+                          for table in tables])
+
+    # Labels are parsed (and memoized) here, the tables are scored in a
+    # single pool
+    def submit(executor, table):
+        *masks, species = scorer.masks(table.ids(axis='observation'),
+                                       taxonomy)
+        return executor.submit(gmhi_sparse, table.matrix_data.T, *masks,
+                               *scorer.parameters, species, scorer.dtype)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [submit(executor, table) for table in tables]
+        return pd.concat([
+            pd.Series(future.result(), index=table.ids(axis='sample'),
+                      name='GMHI')
+            for table, future in zip(tables, futures)])
+
+
+def gmhi_from_qza(table_fp: str,
+                  healthy_species_fp: str = None,
+                  non_healthy_species_fp: str = None,
+                  mh_prime: int = 7,
+                  mn_prime: int = 31,
+                  rel_thresh: float = 0.00001,
+                  log_thresh: float = 0.00001,
+                  chunk_size: int = None,
+                  n_jobs: int = 1,
+                  collapse_species: bool = False,
+                  sample_ids: list = None,
+                  dtype: str = 'float64') -> pd.Series:
     """
-    Calculate Shannon diversity from sample data
+    Calculate GMHI of a FeatureTable[Frequency | RelativeFrequency] .qza
+    file, reading the BIOM payload straight from the archive instead of
+    extracting it with qiime2.Artifact.load
+
+    The artifact type and UUID are validated against its metadata.yaml.
     """
-    return -1 * np.sum(np.log(data) * (data))
-    
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh,
+                        collapse_species, dtype)
+    with _open_qza_biom(table_fp) as (_, _, payload):
+        return scorer.score_biom_file(payload, chunk_size, n_jobs,
+                                      sample_ids=sample_ids)
+
 
 def gmhi_predict(ctx,
                  table=None,
+                 taxonomy=None,
                  healthy_species_fp=None,
                  non_healthy_species_fp=None,
                  mh_prime=7,
                  mn_prime=31,
                  rel_thresh=0.00001,
-                 log_thresh=0.00001):
+                 log_thresh=0.00001,
+                 chunk_size=None,
+                 n_jobs=1,
+                 cache_dir=None,
+                 cache_max_size=1024,
+                 collapse_species=False,
+                 metadata=None,
+                 where=None,
+                 dtype='float64',
+                 incremental_fp=None,
+                 incremental_detect_changes=False):
 
-    # Load and validate species lists
-    healthy_species_list, non_healthy_species_list = \
-        _load_and_validate_species(healthy_species_fp, non_healthy_species_fp)
-
-    # Load and convert feature table (if needed)
-    if table.type == FeatureTable[Frequency]:
-        get_relative = ctx.get_action('feature_table', 'relative_frequency')
-        table, = get_relative(table=table)
-    assert table.type == FeatureTable[RelativeFrequency], \
-        'Feature table not of the type \'RelativeFrequency\''
-
-    # Keep rows as samples, columns as taxonomical species names
-    table_df = table.view(pd.DataFrame)
-
-    # Consider only species from the full taxonomy
-    table_df.columns = table_df.columns.str.split(';').str[-1].str.strip()
-
-    # Remove unclassified and virus species - suitable both for 16S and
-    # Metagenome Sequencing if valid taxonomy is provided
-    na_species = table_df.columns.str.contains('unclassified|virus', regex=True)
-    species_profile_2 = table_df.loc[:, ~na_species]
-
-    # Re-normalization of species' relative abundances after removing
-    # unclassified and virus species
-    species_profile_3 = species_profile_2.apply(lambda x: x / x.sum(), axis=1)
-    species_profile_3[species_profile_3 < rel_thresh] = 0
-
-    # Extracting Health-prevalent species
-    MH_species = species_profile_3.loc[:,
-        species_profile_3.columns.isin(healthy_species_list)]
-    # Extracting Health-scarce species
-    MN_species = species_profile_3.loc[:, 
-        species_profile_3.columns.isin(non_healthy_species_list)]
-
-    assert not MH_species.empty, \
-        "Could not find healthy species in the feature table."
-    assert not MN_species.empty, \
-        "Could not find non-healthy species in the feature table."
-
-    # Shannon index + Alpha diversity
-    MH_not_zero = MH_species[MH_species > 0]
-    MN_not_zero = MN_species[MN_species > 0]
-    MH_shannon = MH_not_zero.apply(shannon_alpha_div, axis=1)
-    MN_shannon = MN_not_zero.apply(shannon_alpha_div, axis=1)
-
-    # Richness of Health-prevalent species
-    R_MH = MH_not_zero.count(axis=1)
-    # Richness of Health-scarce species
-    R_MN = MN_not_zero.count(axis=1)
-
-    psi_MH = (R_MH / mh_prime) * MH_shannon
-    psi_MN = (R_MN / mn_prime) * MN_shannon
-
-    gmhi_df = np.log10((psi_MH + log_thresh) / (psi_MN + log_thresh))
-    gmhi_df.name = 'GMHI'
+    # Calculate GMHI of the samples selected by metadata (if any)
+    gmhi_df = _calculate_gmhi(table, healthy_species_fp,
+                              non_healthy_species_fp, mh_prime, mn_prime,
+                              rel_thresh, log_thresh, chunk_size, n_jobs,
+                              cache_dir, cache_max_size, collapse_species,
+                              taxonomy, _select_sample_ids(metadata, where),
+                              dtype, incremental_fp,
+                              incremental_detect_changes)
 
     # Create and return artifact
     gmhi_artifact = ctx.make_artifact('SampleData[AlphaDiversity]', gmhi_df)
@@ -97,23 +232,39 @@ def gmhi_predict(ctx,
 def gmhi_predict_viz(ctx,
                      table=None,
                      metadata=None,
+                     taxonomy=None,
                      healthy_species_fp=None,
                      non_healthy_species_fp=None,
                      mh_prime=7,
                      mn_prime=31,
                      rel_thresh=0.00001,
-                     log_thresh=0.00001):
+                     log_thresh=0.00001,
+                     chunk_size=None,
+                     n_jobs=1,
+                     cache_dir=None,
+                     cache_max_size=1024,
+                     collapse_species=False,
+                     where=None,
+                     dtype='float64',
+                     incremental_fp=None,
+                     incremental_detect_changes=False):
 
-    # Calculate GMHI
-    gmhi_artifact = gmhi_predict(ctx, table, healthy_species_fp,
-                                 non_healthy_species_fp, mh_prime, mn_prime,
-                                 rel_thresh, log_thresh)
+    # Calculate GMHI of the samples selected by metadata (if any), the
+    # table is decoded only once
+    gmhi_df = _calculate_gmhi(table, healthy_species_fp,
+                              non_healthy_species_fp, mh_prime, mn_prime,
+                              rel_thresh, log_thresh, chunk_size, n_jobs,
+                              cache_dir, cache_max_size, collapse_species,
+                              taxonomy, _select_sample_ids(metadata, where),
+                              dtype, incremental_fp,
+                              incremental_detect_changes)
+    gmhi_artifact = ctx.make_artifact('SampleData[AlphaDiversity]', gmhi_df)
 
     # Load metadata
     metadata_df = _load_metadata(metadata)
-    # Limit metadata to samples preset in the feature table
-    table_df = table.view(pd.DataFrame)
-    metadata_df = _validate_metadata_is_superset(metadata_df, table_df)
+    # Limit metadata to samples preset in the feature table (the same as
+    # the samples scored)
+    metadata_df = _validate_metadata_is_superset(metadata_df, gmhi_df)
     metadata = qiime2.Metadata(metadata_df)
 
     # Create visualization (box plots) similar to that from alpha-diversity
@@ -123,4 +274,3 @@ def gmhi_predict_viz(ctx,
                                         metadata=metadata)
 
     return gmhi_artifact, gmhi_viz[0]
-    
\ No newline at end of file
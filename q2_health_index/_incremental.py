@@ -0,0 +1,207 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import os
+import tempfile
+import warnings
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from q2_health_index._biom_reader import (_read_ids, _read_rows,
+                                          _sample_positions)
+from q2_health_index._scorer import GMHIScorer
+
+FINGERPRINT_PREFIX = '# parameters: '
+TABLE_PREFIX = '# table: '
+HASH_BLOCK_SIZE = 10000
+
+
+def _mix(values: np.ndarray):
+    """
+    SplitMix64 finalizer, spreading the bits of 64-bit integers
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * \
+        np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * \
+        np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def _feature_hashes(feature_ids: pd.Index = None):
+    # Labels rather than positions, so that hashes of unchanged samples
+    # survive features being added to the table
+    return pd.util.hash_array(np.asarray(feature_ids, dtype=object))
+
+
+def _row_hashes(biom_file: h5py.File = None, samples: np.ndarray = None,
+                block_size: int = HASH_BLOCK_SIZE):
+    """
+    64-bit hash of the (feature ID, abundance) pairs of every sample (or
+    of the samples at positions `samples`) of a BIOM 2.1 file, independent
+    of the order of the features
+
+    Returns the hashes as 16 hex digit strings, in the order of the
+    samples.
+    """
+    if samples is None:
+        samples = np.arange(len(biom_file['sample/ids']))
+    feature_hashes = _feature_hashes(_read_ids(biom_file, 'observation'))
+    matrix = biom_file['sample/matrix']
+    indptr = matrix['indptr'][:]
+    hashes = np.zeros(len(samples), dtype=np.uint64)
+    for start in range(0, len(samples), block_size):
+        block = _read_rows(matrix, indptr, samples[start:start + block_size],
+                           len(feature_hashes))
+        with np.errstate(over='ignore'):
+            elements = _mix(feature_hashes[block.indices] ^
+                            block.data.view(np.uint64))
+            # Explicitly stored zeros do not change the sample
+            elements[block.data == 0] = 0
+            # Padding makes offsets of empty trailing rows valid
+            sums = np.add.reduceat(np.append(elements, np.uint64(0)),
+                                   block.indptr[:-1])
+        hashes[start:start + len(sums)] = \
+            np.where(np.diff(block.indptr) > 0, sums, 0)
+    return np.array([f'{value:016x}' for value in hashes], dtype=object)
+
+
+def _empty_results():
+    return pd.DataFrame({'GMHI': pd.Series(dtype=float),
+                         'row-hash': pd.Series(dtype=object)},
+                        index=pd.Index([], name='sample-id', dtype=object))
+
+
+def _load_incremental(incremental_fp: str = None, fingerprint: str = None):
+    """
+    Load previous GMHI results and row hashes, together with the ID of the
+    table all of them were checked against (if any), None if there are
+    none or they were calculated with other parameters
+    """
+    if not os.path.exists(incremental_fp):
+        return None
+    with open(incremental_fp) as fh:
+        if fh.readline().rstrip('\r\n') != FINGERPRINT_PREFIX + fingerprint:
+            print('GMHI parameters changed, all samples are scored again.')
+            return None
+        table_id = None
+        position = fh.tell()
+        line = fh.readline()
+        if line.startswith(TABLE_PREFIX):
+            table_id = line[len(TABLE_PREFIX):].rstrip('\r\n')
+        else:
+            fh.seek(position)
+        return pd.read_csv(fh, sep='\t', index_col=0,
+                           dtype={'sample-id': str, 'row-hash': str}), \
+            table_id
+
+
+def _store_incremental(incremental_fp: str = None, fingerprint: str = None,
+                       results: pd.DataFrame = None, table_id: str = None):
+    directory = os.path.dirname(os.path.abspath(incremental_fp))
+    os.makedirs(directory, exist_ok=True)
+    # Write atomically, a failed run leaves the previous results intact
+    fd, tmp_fp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(FINGERPRINT_PREFIX + fingerprint + '\n')
+        if table_id is not None:
+            fh.write(TABLE_PREFIX + table_id + '\n')
+        results.rename_axis('sample-id').to_csv(fh, sep='\t')
+    os.replace(tmp_fp, incremental_fp)
+
+
+def _append_incremental(incremental_fp: str = None,
+                        results: pd.DataFrame = None):
+    # Rows are formatted first and appended with a single write, so the
+    # previous results are not rewritten
+    rows = results.to_csv(sep='\t', header=False)
+    with open(incremental_fp, 'a') as fh:
+        fh.write(rows)
+
+
+def _score_incremental(scorer: GMHIScorer = None, biom_fp: str = None,
+                       incremental_fp: str = None, fingerprint: str = None,
+                       chunk_size: int = None, n_jobs: int = 1,
+                       taxonomy: pd.Series = None,
+                       sample_ids: list = None,
+                       detect_changes: bool = False,
+                       table_id: str = None) -> pd.Series:
+    """
+    Calculate GMHI of the samples of a BIOM 2.1 file, scoring only the
+    samples that are not in the previous results at `incremental_fp`, and
+    update the results with them
+
+    New samples are found from the sample IDs alone and their results are
+    appended to the file. Row hashes of the scored samples are stored with
+    the results and, with `detect_changes`, the samples whose row hash
+    changed are scored again as well, which reads every abundance of the
+    table. Results of samples no longer in the table are kept, so that the
+    file keeps growing with the cohort.
+
+    `table_id` (e.g. the UUID of the table artifact) is stored as the table
+    all results were checked against, when every sample is scored or
+    checked for changes. Reusing results for another table without change
+    detection warns, as samples whose abundances changed keep their
+    previous GMHI.
+    """
+    loaded = _load_incremental(incremental_fp, fingerprint)
+    rewrite = loaded is None
+    previous, checked_table_id = (_empty_results(), None) \
+        if loaded is None else loaded
+
+    with h5py.File(biom_fp, 'r') as biom_file:
+        samples = _sample_positions(biom_file, sample_ids)
+        table_ids = _read_ids(biom_file, 'sample')
+        if samples is None:
+            samples = np.arange(len(table_ids))
+        table_ids = table_ids[samples]
+
+        if detect_changes:
+            hashes = _row_hashes(biom_file, samples)
+            changed = (previous['row-hash'].reindex(table_ids).to_numpy() !=
+                       hashes)
+            hashes = hashes[changed]
+            # Changed samples already in the file, or the table that
+            # results were checked against, are rewritten
+            rewrite |= bool(table_ids[changed].isin(previous.index).any())
+            rewrite |= checked_table_id != table_id
+        else:
+            changed = ~table_ids.isin(previous.index)
+            hashes = _row_hashes(biom_file, samples[changed]) \
+                if changed.any() else np.zeros(0, dtype=object)
+    changed_ids = table_ids[changed]
+    print(f'GMHI of {len(changed_ids)} new or changed sample(s) is '
+          f'calculated, {len(table_ids) - len(changed_ids)} sample(s) are '
+          f'reused.')
+    n_reused = len(table_ids) - len(changed_ids)
+    if not rewrite and n_reused and checked_table_id != table_id:
+        warnings.warn(f'GMHI of {n_reused} sample(s) in {incremental_fp} was '
+                      f'calculated from another table and is reused without '
+                      f'checking whether their abundances changed, set '
+                      f'incremental_detect_changes to score changed samples '
+                      f'again.', UserWarning)
+
+    scored = pd.DataFrame({'GMHI': pd.Series(dtype=float),
+                           'row-hash': hashes},
+                          index=changed_ids)
+    if len(changed_ids):
+        scored['GMHI'] = scorer.score_biom_file(
+            biom_fp, chunk_size, n_jobs, taxonomy, changed_ids)[changed_ids]
+
+    if rewrite:
+        # Every sample was scored or checked for changes
+        _store_incremental(incremental_fp, fingerprint, pd.concat(
+            [previous[~previous.index.isin(changed_ids)], scored]), table_id)
+    elif len(scored):
+        _append_incremental(incremental_fp, scored)
+
+    gmhi = previous['GMHI'].reindex(table_ids)
+    gmhi[changed_ids] = scored['GMHI']
+    return gmhi.rename('GMHI').rename_axis(None)
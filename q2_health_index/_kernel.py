@@ -0,0 +1,351 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import numpy as np
+from scipy import sparse
+
+
+def _richness_and_shannon(abundances: np.ndarray):
+    """
+    Calculate richness and Shannon diversity of every row (sample),
+    considering only non-zero abundances
+    """
+    present = abundances > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.log(abundances) * abundances
+    shannon = -1 * np.sum(terms, axis=1, where=present, dtype=np.float64)
+    richness = np.count_nonzero(present, axis=1)
+    return richness, shannon
+
+
+def _sparse_richness_and_shannon(abundances: sparse.csr_matrix):
+    """
+    Calculate richness and Shannon diversity of every row (sample) of a
+    CSR matrix holding only positive abundances
+    """
+    rows = np.repeat(np.arange(abundances.shape[0]),
+                     np.diff(abundances.indptr))
+    terms = np.log(abundances.data) * abundances.data
+    # Weights are accumulated in float64 whatever the dtype of the terms
+    shannon = -1 * np.bincount(rows, weights=terms,
+                               minlength=abundances.shape[0])
+    richness = np.diff(abundances.indptr)
+    return richness, shannon
+
+
+def _gmhi_from_psi(psi_mh: np.ndarray, psi_mn: np.ndarray,
+                   log_thresh: float):
+    return np.log10((psi_mh + log_thresh) / (psi_mn + log_thresh))
+
+
+def marker_columns(included: np.ndarray,
+                   healthy: np.ndarray,
+                   non_healthy: np.ndarray,
+                   species: np.ndarray = None):
+    """
+    Select the marker features to project an abundance matrix onto
+
+    Returns the marker feature positions and the healthy and non-healthy
+    masks over them. If `species` (names of all the features) is provided,
+    a sparse features x species aggregation matrix is returned instead of
+    the positions, so that features sharing a species are summed into one
+    marker column.
+    """
+    healthy = np.asarray(healthy) & included
+    non_healthy = np.asarray(non_healthy) & included
+    markers = np.flatnonzero(healthy | non_healthy)
+    if species is None:
+        return markers, healthy[markers], non_healthy[markers]
+
+    # Only the marker features are grouped, so the rest of a large feature
+    # space is never sorted
+    names, columns = np.unique(np.asarray(species)[markers],
+                               return_inverse=True)
+    aggregation = sparse.csr_matrix(
+        (np.ones(len(markers)), (markers, columns)),
+        shape=(len(included), len(names)))
+    healthy_columns = np.zeros(len(names), dtype=bool)
+    healthy_columns[columns[healthy[markers]]] = True
+    non_healthy_columns = np.zeros(len(names), dtype=bool)
+    non_healthy_columns[columns[non_healthy[markers]]] = True
+    return aggregation, healthy_columns, non_healthy_columns
+
+
+def project_dense(abundances: np.ndarray,
+                  included: np.ndarray,
+                  markers,
+                  dtype=np.float64):
+    """
+    Reduce a dense abundance matrix to its marker columns and the
+    per-sample sum of the `included` (classified, non-virus) species
+
+    `markers` are either marker column positions or a sparse aggregation
+    matrix from `marker_columns`. Marker abundances are of `dtype`, the
+    totals are always accumulated in float64.
+    """
+    abundances = np.asarray(abundances, dtype=dtype)
+    totals = abundances @ np.asarray(included, dtype=np.float64)
+    if sparse.issparse(markers):
+        return np.asarray((markers.T.astype(dtype) @ abundances.T).T), totals
+    return abundances[:, markers], totals
+
+
+def _row_totals(abundances: sparse.csr_matrix, included: np.ndarray,
+                block_size: int = 2 ** 20):
+    """
+    Per-row sums of the `included` columns of a CSR matrix, accumulated in
+    float64 in blocks of consecutive rows of about `block_size` values, so
+    a float32 matrix is never upcast as a whole
+    """
+    excluded = ~np.asarray(included, dtype=bool)
+    indptr = abundances.indptr
+    n_rows = abundances.shape[0]
+    totals = np.zeros(n_rows)
+    start = 0
+    while start < n_rows:
+        stop = np.searchsorted(indptr, indptr[start] + block_size, 'right') - 1
+        stop = min(max(stop, start + 1), n_rows)
+        first, last = indptr[start], indptr[stop]
+        values = abundances.data[first:last].astype(np.float64)
+        values[excluded[abundances.indices[first:last]]] = 0
+        offsets = indptr[start:stop + 1] - first
+        # Padding makes offsets of empty trailing rows valid
+        block_totals = np.add.reduceat(np.append(values, 0), offsets[:-1])
+        totals[start:stop] = np.where(np.diff(offsets) > 0, block_totals, 0)
+        start = stop
+    return totals
+
+
+def project_sparse(abundances: sparse.spmatrix,
+                   included: np.ndarray,
+                   markers,
+                   dtype=np.float64):
+    """
+    Reduce a sparse abundance matrix to its marker columns (as CSR) and
+    the per-sample sum of the `included` (classified, non-virus) species
+
+    `markers` are either marker column positions or a sparse aggregation
+    matrix from `marker_columns`. Marker abundances are of `dtype`, the
+    totals are always accumulated in float64.
+    """
+    abundances = sparse.csr_matrix(abundances).astype(dtype, copy=False)
+    totals = _row_totals(abundances, included)
+    if sparse.issparse(markers):
+        return sparse.csr_matrix(abundances @ markers.astype(dtype)), totals
+    return abundances[:, markers], totals
+
+
+def _renormalize(markers, totals: np.ndarray):
+    """
+    Re-normalize marker abundances with the per-sample totals, samples with
+    zero total end up as NaN and are later skipped as non-present
+
+    Floating point marker abundances keep their dtype (e.g. float32).
+    """
+    if not sparse.issparse(markers):
+        markers = np.asarray(markers)
+    dtype = markers.dtype if np.issubdtype(markers.dtype, np.floating) \
+        else np.float64
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if sparse.issparse(markers):
+            markers = sparse.csr_matrix(markers, dtype=dtype, copy=True)
+            markers.data /= np.repeat(totals, np.diff(markers.indptr))
+            return markers
+        return (markers.astype(dtype, copy=False) /
+                np.asarray(totals)[:, np.newaxis]).astype(dtype, copy=False)
+
+
+def _marker_diversity(renormalized, healthy: np.ndarray,
+                      non_healthy: np.ndarray, rel_thresh: float):
+    """
+    Threshold re-normalized marker abundances and calculate richness and
+    Shannon diversity of the healthy and non-healthy markers
+    """
+    if sparse.issparse(renormalized):
+        thresholded = renormalized.copy()
+        # Thresholding drops NaN (samples with zero total) as well
+        keep = (thresholded.data >= rel_thresh) & (thresholded.data > 0)
+        thresholded.data[~keep] = 0
+        thresholded.eliminate_zeros()
+        richness_and_shannon = _sparse_richness_and_shannon
+    else:
+        thresholded = np.where(renormalized < rel_thresh, 0, renormalized)
+        richness_and_shannon = _richness_and_shannon
+
+    R_MH, MH_shannon = richness_and_shannon(thresholded[:, healthy])
+    R_MN, MN_shannon = richness_and_shannon(thresholded[:, non_healthy])
+    return R_MH, MH_shannon, R_MN, MN_shannon
+
+
+def gmhi_projected(markers,
+                   totals: np.ndarray,
+                   healthy: np.ndarray,
+                   non_healthy: np.ndarray,
+                   mh_prime: float = 7,
+                   mn_prime: float = 31,
+                   rel_thresh: float = 0.00001,
+                   log_thresh: float = 0.00001):
+    """
+    Calculate GMHI from marker abundances (dense or sparse, samples x
+    markers) and the per-sample totals used for re-normalization
+
+    `healthy` and `non_healthy` are boolean masks over the marker columns.
+    Samples without any classified species (zero total) score 0.
+    """
+    R_MH, MH_shannon, R_MN, MN_shannon = _marker_diversity(
+        _renormalize(markers, totals), healthy, non_healthy, rel_thresh)
+
+    psi_MH = (R_MH / mh_prime) * MH_shannon
+    psi_MN = (R_MN / mn_prime) * MN_shannon
+
+    return _gmhi_from_psi(psi_MH, psi_MN, log_thresh)
+
+
+def gmhi_sweep(markers,
+               totals: np.ndarray,
+               healthy: np.ndarray,
+               non_healthy: np.ndarray,
+               mh_primes: list = (7,),
+               mn_primes: list = (31,),
+               rel_threshs: list = (0.00001,),
+               log_threshs: list = (0.00001,)):
+    """
+    Calculate GMHI for every combination of the parameter values in one
+    pass over the marker abundances
+
+    Markers are re-normalized once and thresholded once per `rel_thresh`,
+    the primes and `log_thresh` are broadcast over the richness and Shannon
+    diversity. Returns a samples x combinations array, with combinations
+    ordered as `itertools.product(mh_primes, mn_primes, rel_threshs,
+    log_threshs)`.
+    """
+    renormalized = _renormalize(markers, totals)
+    R_MH, MH_shannon, R_MN, MN_shannon = map(np.array, zip(*[
+        _marker_diversity(renormalized, healthy, non_healthy, rel_thresh)
+        for rel_thresh in rel_threshs]))
+
+    # Axes: mh_prime, mn_prime, rel_thresh, log_thresh, sample
+    mh_primes = np.asarray(mh_primes, dtype=np.float64)
+    mn_primes = np.asarray(mn_primes, dtype=np.float64)
+    log_threshs = np.asarray(log_threshs, dtype=np.float64)
+    psi_MH = (R_MH / mh_primes[:, None, None]) * MH_shannon
+    psi_MN = (R_MN / mn_primes[:, None, None]) * MN_shannon
+    gmhi = _gmhi_from_psi(psi_MH[:, None, :, None, :],
+                          psi_MN[None, :, :, None, :],
+                          log_threshs[None, None, None, :, None])
+
+    return gmhi.reshape(-1, gmhi.shape[-1]).T
+
+
+def gmhi_rel_thresh_curve(markers,
+                          totals: np.ndarray,
+                          healthy: np.ndarray,
+                          non_healthy: np.ndarray,
+                          mh_prime: float = 7,
+                          mn_prime: float = 31,
+                          log_thresh: float = 0.00001):
+    """
+    Calculate the exact, piecewise constant GMHI as a function of
+    `rel_thresh` for every sample
+
+    Marker abundances of every sample are sorted once in descending order,
+    so that the species kept by any threshold form a prefix, and richness
+    and Shannon sums are accumulated along it. Returns (sample positions,
+    lower, upper, GMHI) arrays: GMHI holds for lower < rel_thresh <= upper.
+    """
+    renormalized = _renormalize(markers, totals)
+    if sparse.issparse(renormalized):
+        renormalized = renormalized.toarray()
+    renormalized = np.where(renormalized > 0, renormalized, 0)
+    n_samples, n_markers = renormalized.shape
+
+    order = np.argsort(-renormalized, axis=1, kind='stable')
+    values = np.take_along_axis(renormalized, order, axis=1)
+    present = values > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(present, -1 * np.log(values) * values, 0)
+    is_mh = np.asarray(healthy)[order] & present
+    is_mn = np.asarray(non_healthy)[order] & present
+
+    # Richness and Shannon of the species kept by the threshold equal to
+    # the abundance at every position of the sorted rows
+    psi_MH = (np.cumsum(is_mh, axis=1) / mh_prime) * \
+        np.cumsum(np.where(is_mh, terms, 0), axis=1)
+    psi_MN = (np.cumsum(is_mn, axis=1) / mn_prime) * \
+        np.cumsum(np.where(is_mn, terms, 0), axis=1)
+    gmhi = _gmhi_from_psi(psi_MH, psi_MN, log_thresh)
+
+    # Breakpoints are the last positions of runs of tied abundances
+    next_values = np.hstack([values[:, 1:], np.zeros((n_samples, 1))])
+    breakpoints = present & (values != next_values)
+    samples, positions = np.nonzero(breakpoints)
+    lower = next_values[samples, positions]
+    upper = values[samples, positions]
+    gmhi = gmhi[samples, positions]
+
+    # Above the highest abundance no species is kept and GMHI is 0
+    highest = values[:, 0] if n_markers else np.zeros(n_samples)
+    samples = np.concatenate([samples, np.arange(n_samples)])
+    lower = np.concatenate([lower, highest])
+    upper = np.concatenate([upper, np.full(n_samples, np.inf)])
+    gmhi = np.concatenate([gmhi, np.zeros(n_samples)])
+
+    order = np.lexsort((lower, samples))
+    return samples[order], lower[order], upper[order], gmhi[order]
+
+
+def gmhi_dense(abundances: np.ndarray,
+               included: np.ndarray,
+               healthy: np.ndarray,
+               non_healthy: np.ndarray,
+               mh_prime: float = 7,
+               mn_prime: float = 31,
+               rel_thresh: float = 0.00001,
+               log_thresh: float = 0.00001,
+               species: np.ndarray = None,
+               dtype=np.float64):
+    """
+    Calculate GMHI for every row (sample) of a dense abundance matrix
+
+    `included`, `healthy` and `non_healthy` are boolean masks over the
+    columns (species) of `abundances`. Columns not `included` (unclassified
+    and virus species) are dropped before re-normalization. Only the marker
+    columns are re-normalized, the rest contributes through the totals.
+    If `species` is provided, columns of the same species are summed.
+    With `dtype` float32, marker abundances, re-normalization and the
+    Shannon terms are float32, sums are accumulated in float64.
+    """
+    markers, healthy, non_healthy = marker_columns(
+        included, healthy, non_healthy, species)
+    markers, totals = project_dense(abundances, included, markers, dtype)
+    return gmhi_projected(markers, totals, healthy, non_healthy,
+                          mh_prime, mn_prime, rel_thresh, log_thresh)
+
+
+def gmhi_sparse(abundances: sparse.spmatrix,
+                included: np.ndarray,
+                healthy: np.ndarray,
+                non_healthy: np.ndarray,
+                mh_prime: float = 7,
+                mn_prime: float = 31,
+                rel_thresh: float = 0.00001,
+                log_thresh: float = 0.00001,
+                species: np.ndarray = None,
+                dtype=np.float64):
+    """
+    Calculate GMHI for every row (sample) of a sparse abundance matrix
+
+    Same as `gmhi_dense`, but all the per-element work is done over the
+    stored non-zeros only, so memory grows with the number of non-zeros
+    rather than with samples x species.
+    """
+    markers, healthy, non_healthy = marker_columns(
+        included, healthy, non_healthy, species)
+    markers, totals = project_sparse(abundances, included, markers, dtype)
+    return gmhi_projected(markers, totals, healthy, non_healthy,
+                          mh_prime, mn_prime, rel_thresh, log_thresh)
@@ -0,0 +1,117 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from q2_health_index._utilities import _parse_species
+
+LABEL_INDEX_SUFFIX = '.labels.npz'
+LABEL_INDEX_CACHE_SIZE = 16
+
+LabelIndex = collections.namedtuple(
+    'LabelIndex', ['species', 'included', 'healthy', 'non_healthy'])
+
+# Label indices of the recently seen feature spaces, keyed by digest
+_LABEL_INDEX_CACHE = collections.OrderedDict()
+
+
+def _digest(values: list):
+    return hashlib.sha256(
+        '\0'.join(map(str, values)).encode('utf8')).hexdigest()
+
+
+def _taxonomy_labels(feature_ids: list = None,
+                     taxonomy: pd.Series = None):
+    """
+    Replace feature IDs (e.g. ASV hashes) with their taxonomy strings,
+    looked up through the hash index of the taxonomy in one pass
+    """
+    positions = taxonomy.index.get_indexer(feature_ids)
+    missing = positions == -1
+    if missing.any():
+        raise ValueError(
+            f'{missing.sum()} feature(s) of the feature table are not '
+            f'present in the taxonomy, e.g.: '
+            f'{", ".join(map(str, np.asarray(feature_ids)[missing][:5]))}')
+    return taxonomy.to_numpy(dtype=object)[positions]
+
+
+def _build_label_index(feature_ids: list = None,
+                       healthy_species_list: list = None,
+                       non_healthy_species_list: list = None):
+    # Parse every distinct label only once
+    codes, labels = pd.factorize(np.asarray(feature_ids, dtype=object))
+    species = _parse_species(labels)
+
+    # Remove unclassified and virus species - suitable both for 16S and
+    # Metagenome Sequencing if valid taxonomy is provided
+    included = ~np.asarray(
+        species.str.contains('unclassified|virus', regex=True), dtype=bool)
+
+    # Extracting Health-prevalent and Health-scarce species
+    healthy = species.isin(healthy_species_list) & included
+    non_healthy = species.isin(non_healthy_species_list) & included
+
+    return LabelIndex(np.asarray(species, dtype=str)[codes], included[codes],
+                      healthy[codes], non_healthy[codes])
+
+
+def _label_index(feature_ids: list = None,
+                 healthy_species_list: list = None,
+                 non_healthy_species_list: list = None,
+                 cache_dir: str = None):
+    """
+    Parse feature labels into species names, inclusion (not unclassified
+    or virus) and marker panel membership
+
+    Results are memoized in memory and, if `cache_dir` is provided,
+    persisted there, keyed by the hash of the feature IDs and of the panel.
+    Persisted label indices count towards the size of the results cache
+    and are evicted with it (see `_cache_store`).
+    """
+    key = _digest(feature_ids) + _digest(
+        ['healthy'] + sorted(healthy_species_list) +
+        ['non_healthy'] + sorted(non_healthy_species_list))[:16]
+
+    if key in _LABEL_INDEX_CACHE:
+        _LABEL_INDEX_CACHE.move_to_end(key)
+        return _LABEL_INDEX_CACHE[key]
+
+    fp = os.path.join(cache_dir, key + LABEL_INDEX_SUFFIX) \
+        if cache_dir else None
+    label_index = None
+    if fp and os.path.exists(fp):
+        try:
+            with np.load(fp) as stored:
+                label_index = LabelIndex(*(stored[field]
+                                           for field in LabelIndex._fields))
+            # Mark as recently used for the LRU eviction
+            os.utime(fp)
+        except (FileNotFoundError, KeyError, ValueError):
+            # Evicted by a concurrent run in the meantime
+            label_index = None
+    if label_index is None:
+        label_index = _build_label_index(feature_ids, healthy_species_list,
+                                         non_healthy_species_list)
+        if fp:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_fp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez_compressed(fh, **label_index._asdict())
+            os.replace(tmp_fp, fp)
+
+    _LABEL_INDEX_CACHE[key] = label_index
+    if len(_LABEL_INDEX_CACHE) > LABEL_INDEX_CACHE_SIZE:
+        _LABEL_INDEX_CACHE.popitem(last=False)
+    return label_index
@@ -0,0 +1,226 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import functools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from q2_health_index._kernel import gmhi_projected
+from q2_health_index._scorer import GMHIScorer
+
+# Columns of MetaPhlAn tables that do not hold abundances
+NON_SAMPLE_COLUMNS = ('NCBI_tax_id', 'clade_taxid')
+
+EXCLUDED_SPECIES = re.compile('unclassified|virus')
+
+
+def _parse_clade(clade_name: str):
+    """
+    Return the species of a species-level clade name (either a '|' or ';'
+    separated lineage, or a bare species name), otherwise None
+    """
+    species = clade_name.replace('|', ';').split(';')[-1].strip()
+    # Strain (t__) and higher rank rows would count the abundance twice
+    return species if species.startswith('s__') else None
+
+
+def _read_metaphlan_table(metaphlan_table_fp: str = None,
+                          healthy_species_list: list = None,
+                          non_healthy_species_list: list = None):
+    """
+    Stream a MetaPhlAn merged abundance table (clades x samples) and keep
+    only the marker species rows and per-sample totals of the classified
+    species
+
+    Returns sample IDs, marker abundances (samples x markers), totals and
+    healthy and non-healthy masks over the markers.
+    """
+    healthy_species = set(healthy_species_list)
+    non_healthy_species = set(non_healthy_species_list)
+
+    with open(metaphlan_table_fp) as fh:
+        # Header is the first line that is not a comment (e.g. the
+        # '#mpa_v30_CHOCOPhlAn_201901' database line)
+        header = next(line for line in fh if not line.startswith('#'))
+        columns = header.rstrip('\r\n').split('\t')[1:]
+        sample_columns = [i for i, column in enumerate(columns)
+                          if column not in NON_SAMPLE_COLUMNS]
+        sample_ids = pd.Index([columns[i] for i in sample_columns])
+
+        totals = np.zeros(len(sample_columns))
+        markers, healthy, non_healthy = [], [], []
+        for line in fh:
+            clade_name, *values = line.rstrip('\r\n').split('\t')
+            species = _parse_clade(clade_name)
+            if species is None or EXCLUDED_SPECIES.search(species):
+                continue
+            # Tax ID columns hold '|' separated lineages, not numbers
+            abundances = np.array([values[i] for i in sample_columns],
+                                  dtype=np.float64)
+            totals += abundances
+            if species in healthy_species or species in non_healthy_species:
+                markers.append(abundances)
+                healthy.append(species in healthy_species)
+                non_healthy.append(species in non_healthy_species)
+
+    assert any(healthy), \
+        "Could not find healthy species in the feature table."
+    assert any(non_healthy), \
+        "Could not find non-healthy species in the feature table."
+
+    return (sample_ids, np.array(markers).T, totals, np.array(healthy),
+            np.array(non_healthy))
+
+
+def _read_metaphlan_profile(profile_fp: str = None,
+                            panel: dict = None):
+    """
+    Read a single-sample MetaPhlAn profile into marker abundances, ordered
+    as the `panel` (species -> position), and the total of the classified
+    species
+    """
+    markers = np.zeros(len(panel))
+    total = 0.0
+    # MetaPhlAn 2 profiles only hold the clade name and abundance
+    abundance_column = 1
+    with open(profile_fp) as fh:
+        for line in fh:
+            fields = line.rstrip('\r\n').split('\t')
+            if line.startswith('#'):
+                # MetaPhlAn 3+ profiles name the columns, with tax IDs
+                # preceding the abundances
+                if fields[0] == '#clade_name':
+                    abundance_column = fields.index('relative_abundance')
+                continue
+            species = _parse_clade(fields[0])
+            if species is None or EXCLUDED_SPECIES.search(species):
+                continue
+            abundance = float(fields[abundance_column])
+            total += abundance
+            # Duplicated species rows add up, as they do in the total
+            if species in panel:
+                markers[panel[species]] += abundance
+    return markers, total
+
+
+def _score_profile(profile_fp: str, panel: dict = None,
+                   healthy: np.ndarray = None, non_healthy: np.ndarray = None,
+                   parameters: tuple = ()):
+    """
+    Calculate GMHI of a single-sample MetaPhlAn profile
+
+    Returns GMHI, whether any healthy and non-healthy marker is present and
+    the error message if the profile could not be parsed. Errors are not
+    raised, so that one broken file does not abort the batch.
+    """
+    try:
+        markers, total = _read_metaphlan_profile(profile_fp, panel)
+    except (OSError, UnicodeDecodeError, ValueError, IndexError) as error:
+        return np.nan, False, False, f'{type(error).__name__}: {error}'
+    gmhi = gmhi_projected(markers[np.newaxis, :], np.array([total]),
+                          healthy, non_healthy, *parameters)[0]
+    present = markers > 0
+    return (gmhi, (present & healthy).any(), (present & non_healthy).any(),
+            None)
+
+
+def _score_metaphlan_profiles(profile_fps: list = None,
+                              scorer: GMHIScorer = None,
+                              n_jobs: int = 1):
+    """
+    Parse and score single-sample profiles in a pool of `n_jobs`
+    processes, every sample is scored as soon as its profile is parsed
+
+    Returns GMHI of every profile (NaN if the profile could not be parsed)
+    and the {profile path: error message} of the failed ones.
+    """
+    score = functools.partial(
+        _score_profile, panel=scorer.panel, healthy=scorer.healthy,
+        non_healthy=scorer.non_healthy, parameters=scorer.parameters)
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(
+                score, profile_fps,
+                chunksize=max(len(profile_fps) // (4 * n_jobs), 1)))
+    else:
+        results = list(map(score, profile_fps))
+
+    gmhi, has_healthy, has_non_healthy, errors = zip(*results)
+    failures = {profile_fp: error for profile_fp, error
+                in zip(profile_fps, errors) if error is not None}
+
+    if len(failures) < len(profile_fps):
+        assert any(has_healthy), \
+            "Could not find healthy species in the feature table."
+        assert any(has_non_healthy), \
+            "Could not find non-healthy species in the feature table."
+    return np.array(gmhi), failures
+
+
+def calculate_gmhi_metaphlan(metaphlan_table_fp: str,
+                             healthy_species_fp: str = None,
+                             non_healthy_species_fp: str = None,
+                             mh_prime: int = 7,
+                             mn_prime: int = 31,
+                             rel_thresh: float = 0.00001,
+                             log_thresh: float = 0.00001) -> pd.Series:
+    # Load and validate species lists
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh)
+
+    sample_ids, markers, totals, healthy, non_healthy = \
+        _read_metaphlan_table(metaphlan_table_fp, scorer.healthy_species,
+                              scorer.non_healthy_species)
+    gmhi = gmhi_projected(markers, totals, healthy, non_healthy,
+                          *scorer.parameters)
+    return pd.Series(gmhi, index=sample_ids, name='GMHI')
+
+
+def calculate_gmhi_metaphlan_profiles(metaphlan_profiles_dir: str,
+                                      profile_suffix: str = '.txt',
+                                      healthy_species_fp: str = None,
+                                      non_healthy_species_fp: str = None,
+                                      mh_prime: int = 7,
+                                      mn_prime: int = 31,
+                                      rel_thresh: float = 0.00001,
+                                      log_thresh: float = 0.00001,
+                                      n_jobs: int = 1) -> pd.Series:
+    # Load and validate species lists
+    scorer = GMHIScorer(healthy_species_fp, non_healthy_species_fp,
+                        mh_prime, mn_prime, rel_thresh, log_thresh)
+
+    # Sample IDs are the profile file names without the suffix
+    file_names = sorted(name for name in os.listdir(metaphlan_profiles_dir)
+                        if name.endswith(profile_suffix))
+    if not file_names:
+        raise ValueError(f'No MetaPhlAn profiles ending with '
+                         f'\'{profile_suffix}\' found in '
+                         f'{metaphlan_profiles_dir}')
+    profile_fps = [os.path.join(metaphlan_profiles_dir, name)
+                   for name in file_names]
+    sample_ids = pd.Index([name[:len(name) - len(profile_suffix)]
+                           for name in file_names])
+
+    gmhi, failures = _score_metaphlan_profiles(profile_fps, scorer, n_jobs)
+
+    # Broken profiles are reported and left out, without aborting the batch
+    if failures:
+        print(f'Could not parse {len(failures)} of {len(profile_fps)} '
+              f'MetaPhlAn profiles, the samples are skipped:')
+        for profile_fp, error in failures.items():
+            print(f'  {profile_fp}: {error}')
+    if len(failures) == len(profile_fps):
+        raise ValueError('None of the MetaPhlAn profiles could be parsed.')
+
+    gmhi = pd.Series(gmhi, index=sample_ids, name='GMHI')
+    return gmhi[gmhi.notna()]
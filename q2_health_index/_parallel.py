@@ -0,0 +1,111 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from q2_health_index._kernel import (gmhi_projected, gmhi_sparse,
+                                     marker_columns, project_sparse)
+
+
+def _share(array: np.ndarray):
+    """
+    Copy an array into a new shared memory block, returning the block and
+    a picklable (name, shape, dtype) descriptor of it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(descriptor: tuple):
+    name, shape, dtype = descriptor
+    # Workers share the resource tracker of the parent, which unlinks the
+    # blocks once all the shards are scored
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _score_shard(descriptors: tuple, n_features: int, start: int, stop: int,
+                 included: np.ndarray, columns: tuple, parameters: tuple,
+                 dtype=np.float64):
+    """
+    Calculate GMHI of samples [start, stop) of a CSR matrix kept in
+    shared memory
+    """
+    shms, (data, indices, indptr) = zip(*map(_attach, descriptors))
+    try:
+        first, last = indptr[start], indptr[stop]
+        shard = sparse.csr_matrix(
+            (data[first:last], indices[first:last],
+             indptr[start:stop + 1] - first),
+            shape=(stop - start, n_features))
+        markers, healthy, non_healthy = columns
+        gmhi = gmhi_projected(*project_sparse(shard, included, markers,
+                                              dtype),
+                              healthy, non_healthy, *parameters)
+        # Views must be released before the shared memory can be closed
+        del shard, data, indices, indptr
+    finally:
+        for shm in shms:
+            shm.close()
+    return gmhi
+
+
+def gmhi_parallel(abundances: sparse.spmatrix,
+                  included: np.ndarray,
+                  healthy: np.ndarray,
+                  non_healthy: np.ndarray,
+                  mh_prime: float = 7,
+                  mn_prime: float = 31,
+                  rel_thresh: float = 0.00001,
+                  log_thresh: float = 0.00001,
+                  n_jobs: int = 1,
+                  species: np.ndarray = None,
+                  dtype=np.float64):
+    """
+    Calculate GMHI for every row (sample) of a sparse abundance matrix,
+    scoring shards of samples in a pool of `n_jobs` processes
+
+    The CSR arrays are passed to the workers through shared memory and
+    the results are returned in the original sample order. If `species`
+    is provided, features of the same species are summed (see
+    `marker_columns`). Abundances are shared and scored as `dtype`.
+    """
+    abundances = sparse.csr_matrix(abundances, dtype=dtype)
+    n_samples, n_features = abundances.shape
+    n_jobs = max(min(n_jobs, n_samples), 1)
+    if n_jobs == 1:
+        return gmhi_sparse(abundances, included, healthy, non_healthy,
+                           mh_prime, mn_prime, rel_thresh, log_thresh,
+                           species, dtype)
+
+    # Markers are selected once, workers only receive the small projection
+    included = np.asarray(included)
+    columns = marker_columns(included, healthy, non_healthy, species)
+    parameters = (mh_prime, mn_prime, rel_thresh, log_thresh)
+    bounds = np.linspace(0, n_samples, n_jobs + 1).astype(int)
+
+    shared = [_share(array) for array in (abundances.data,
+                                          abundances.indices,
+                                          abundances.indptr)]
+    descriptors = tuple(descriptor for _, descriptor in shared)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            shards = [executor.submit(_score_shard, descriptors, n_features,
+                                      start, stop, included, columns,
+                                      parameters, dtype)
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+            return np.concatenate([shard.result() for shard in shards])
+    finally:
+        for shm, _ in shared:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,143 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import contextlib
+import io
+import mmap
+import tempfile
+import zipfile
+
+import yaml
+
+FEATURE_TABLE_TYPES = ('FeatureTable[Frequency]',
+                       'FeatureTable[RelativeFrequency]')
+BIOM_MEMBER = 'data/feature-table.biom'
+# Deflated payloads up to this size are inflated into memory, larger ones
+# into a temporary file
+INFLATE_IN_MEMORY_MAX_SIZE = 1 << 24
+
+
+class _MemberWindow(io.RawIOBase):
+    """
+    Read-only, seekable window over the bytes of a memory-mapped file, used
+    to read an uncompressed (stored) zip member in place
+    """
+
+    def __init__(self, buffer: mmap.mmap, offset: int, size: int):
+        self._buffer = buffer
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position: int, whence: int = io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self._position,
+                 io.SEEK_END: self._size}[whence]
+        self._position = max(start + position, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        start = min(self._position, self._size)
+        stop = min(start + len(buffer), self._size)
+        buffer[:stop - start] = \
+            self._buffer[self._offset + start:self._offset + stop]
+        self._position = stop
+        return stop - start
+
+
+def _read_artifact_metadata(archive: zipfile.ZipFile):
+    """
+    Validate the root metadata.yaml of a .qza archive, returning the UUID
+    and the semantic type of the artifact
+    """
+    roots = {name.split('/', 1)[0] for name in archive.namelist()}
+    if len(roots) != 1:
+        raise ValueError('Not a QIIME 2 artifact: expected a single root '
+                         'directory in the archive.')
+    root = roots.pop()
+    try:
+        metadata = yaml.safe_load(archive.read(f'{root}/metadata.yaml'))
+    except KeyError:
+        raise ValueError('Not a QIIME 2 artifact: metadata.yaml is missing.')
+
+    if str(metadata.get('uuid')) != root:
+        raise ValueError(f'Artifact UUID {metadata.get("uuid")} does not '
+                         f'match the archive root directory {root}.')
+    if metadata.get('type') not in FEATURE_TABLE_TYPES:
+        raise ValueError(f'Feature table not of the type \'Frequency\' or '
+                         f'\'RelativeFrequency\': {metadata.get("type")}')
+    return root, metadata['type']
+
+
+def _biom_member(archive: zipfile.ZipFile):
+    """
+    Validate a feature table .qza archive, returning the artifact UUID, the
+    semantic type and the zip member of the BIOM 2.1 payload
+    """
+    uuid, semantic_type = _read_artifact_metadata(archive)
+    try:
+        member = archive.getinfo(f'{uuid}/{BIOM_MEMBER}')
+    except KeyError:
+        raise ValueError(f'Artifact {uuid} does not hold a BIOM 2.1 '
+                         f'feature table.')
+    return uuid, semantic_type, member
+
+
+def _extract_qza_biom(qza_fp: str = None, directory: str = None):
+    """
+    Validate a feature table .qza and inflate its deflated BIOM 2.1 payload
+    into `directory`, returning the path of the payload, or None if the
+    payload is stored uncompressed and can be read in place
+    """
+    with zipfile.ZipFile(qza_fp) as archive:
+        _, _, member = _biom_member(archive)
+        if member.compress_type == zipfile.ZIP_STORED:
+            return None
+        return archive.extract(member, directory)
+
+
+@contextlib.contextmanager
+def _open_qza_biom(qza_fp: str = None):
+    """
+    Open the BIOM 2.1 payload of a feature table .qza without extracting
+    the whole archive, yielding (artifact UUID, semantic type, payload)
+    where the payload is a seekable file object or a path h5py can open
+
+    Stored (uncompressed) members are memory-mapped and read in place.
+    Deflated members, which is how QIIME 2 writes them, have to be inflated
+    once (HDF5 needs random access, which deflate streams cannot provide):
+    small ones into memory, larger ones into a temporary file, so memory
+    does not grow with the table.
+    """
+    with open(qza_fp, 'rb') as fh, zipfile.ZipFile(fh) as archive:
+        uuid, semantic_type, member = _biom_member(archive)
+        if member.compress_type != zipfile.ZIP_STORED:
+            if member.file_size <= INFLATE_IN_MEMORY_MAX_SIZE:
+                yield uuid, semantic_type, io.BytesIO(archive.read(member))
+                return
+            # Only the payload is extracted, not the rest of the archive
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                yield uuid, semantic_type, archive.extract(member, tmp_dir)
+            return
+
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # The local header has its own, variable length fields
+            header = buffer[member.header_offset:member.header_offset + 30]
+            offset = member.header_offset + 30 + \
+                int.from_bytes(header[26:28], 'little') + \
+                int.from_bytes(header[28:30], 'little')
+            yield uuid, semantic_type, _MemberWindow(buffer, offset,
+                                                     member.file_size)
@@ -0,0 +1,170 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import biom
+import h5py
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from q2_health_index._biom_reader import (_iter_sample_blocks,
+                                          _read_marker_projection, _read_ids,
+                                          _sample_positions)
+from q2_health_index._kernel import (gmhi_dense, gmhi_projected,
+                                     marker_columns)
+from q2_health_index._labels import _label_index, _taxonomy_labels
+from q2_health_index._parallel import gmhi_parallel
+from q2_health_index._utilities import _load_and_validate_species
+
+
+def _species_masks(feature_ids: pd.Index = None,
+                   healthy_species_list: list = None,
+                   non_healthy_species_list: list = None,
+                   cache_dir: str = None,
+                   collapse_species: bool = False,
+                   taxonomy: pd.Series = None):
+    if taxonomy is not None:
+        feature_ids = _taxonomy_labels(feature_ids, taxonomy)
+
+    # Labels are parsed once per feature space and panel
+    label_index = _label_index(feature_ids, healthy_species_list,
+                               non_healthy_species_list, cache_dir)
+
+    assert label_index.healthy.any(), \
+        "Could not find healthy species in the feature table."
+    assert label_index.non_healthy.any(), \
+        "Could not find non-healthy species in the feature table."
+
+    # Species names are only needed to sum features of the same species
+    species = label_index.species if collapse_species else None
+    return (label_index.included, label_index.healthy,
+            label_index.non_healthy, species)
+
+
+class GMHIScorer:
+    """
+    Marker panel and GMHI parameters compiled once, for scoring many
+    abundance matrices (e.g. small batches in a notebook or a service)
+
+    The species lists are loaded and validated when the scorer is created
+    and the parsed labels of every feature space are memoized (see
+    `_label_index`), so scoring a batch over an already seen feature space
+    only costs a hash of its feature IDs on top of the kernel itself.
+    """
+
+    def __init__(self,
+                 healthy_species_fp: str = None,
+                 non_healthy_species_fp: str = None,
+                 mh_prime: int = 7,
+                 mn_prime: int = 31,
+                 rel_thresh: float = 0.00001,
+                 log_thresh: float = 0.00001,
+                 collapse_species: bool = False,
+                 dtype: str = 'float64',
+                 cache_dir: str = None):
+        self.healthy_species, self.non_healthy_species = \
+            _load_and_validate_species(healthy_species_fp,
+                                       non_healthy_species_fp)
+        # Marker species -> position, with healthy and non-healthy masks
+        # over the positions
+        self.species = sorted(set(self.healthy_species) |
+                              set(self.non_healthy_species))
+        self.panel = {name: position
+                      for position, name in enumerate(self.species)}
+        self.healthy = np.isin(self.species, self.healthy_species)
+        self.non_healthy = np.isin(self.species, self.non_healthy_species)
+
+        self.parameters = (mh_prime, mn_prime, rel_thresh, log_thresh)
+        self.collapse_species = collapse_species
+        self.dtype = np.dtype(dtype)
+        self.cache_dir = cache_dir
+
+    def masks(self, feature_ids: list = None, taxonomy: pd.Series = None):
+        """
+        Inclusion, healthy and non-healthy masks over the features and
+        their species names (only if species are collapsed, else None)
+        """
+        return _species_masks(feature_ids, self.healthy_species,
+                              self.non_healthy_species, self.cache_dir,
+                              self.collapse_species, taxonomy)
+
+    def score(self, abundances, feature_ids: list = None,
+              taxonomy: pd.Series = None, n_jobs: int = 1) -> np.ndarray:
+        """
+        Calculate GMHI of every row (sample) of a dense or sparse
+        samples x features abundance matrix, whose columns are labeled with
+        `feature_ids` (taxonomy strings, or IDs looked up in `taxonomy`)
+        """
+        *masks, species = self.masks(feature_ids, taxonomy)
+        if sparse.issparse(abundances):
+            return gmhi_parallel(abundances, *masks, *self.parameters,
+                                 n_jobs, species, self.dtype)
+        return gmhi_dense(abundances, *masks, *self.parameters, species,
+                          self.dtype)
+
+    def score_table(self, table: biom.Table = None,
+                    taxonomy: pd.Series = None,
+                    n_jobs: int = 1) -> pd.Series:
+        """
+        Calculate GMHI of every sample of a biom.Table
+        """
+        # Keep the table sparse, rows as samples, columns as taxonomical
+        # species names
+        gmhi = self.score(table.matrix_data.T, table.ids(axis='observation'),
+                          taxonomy, n_jobs)
+        return pd.Series(gmhi, index=table.ids(axis='sample'), name='GMHI')
+
+    def iter_biom_file(self, biom_fp=None, chunk_size: int = None,
+                       n_jobs: int = 1, taxonomy: pd.Series = None,
+                       sample_ids: list = None):
+        """
+        Stream blocks of `chunk_size` samples (or only the selected samples)
+        from a BIOM 2.1 file (path or file object) and yield GMHI of every
+        block as soon as it is calculated
+        """
+        with h5py.File(biom_fp, 'r') as biom_file:
+            *masks, species = self.masks(_read_ids(biom_file, 'observation'),
+                                         taxonomy)
+            samples = _sample_positions(biom_file, sample_ids)
+            blocks = _iter_sample_blocks(biom_file, chunk_size, samples,
+                                         self.dtype)
+            for block_ids, block in blocks:
+                gmhi = gmhi_parallel(block, *masks, *self.parameters, n_jobs,
+                                     species, self.dtype)
+                yield pd.Series(gmhi, index=block_ids, name='GMHI')
+
+    def score_biom_file(self, biom_fp=None, chunk_size: int = None,
+                        n_jobs: int = 1, taxonomy: pd.Series = None,
+                        sample_ids: list = None) -> pd.Series:
+        """
+        Calculate GMHI of (the selected) samples of a BIOM 2.1 file (path
+        or file object)
+
+        Without `chunk_size` and parallelism, only the marker features and
+        the per-sample totals are read from the file.
+        """
+        if chunk_size or n_jobs > 1:
+            # Peak memory is bound by the chunk size (if any)
+            return pd.concat(self.iter_biom_file(biom_fp, chunk_size, n_jobs,
+                                                 taxonomy, sample_ids))
+
+        with h5py.File(biom_fp, 'r') as biom_file:
+            included, healthy, non_healthy, species = self.masks(
+                _read_ids(biom_file, 'observation'), taxonomy)
+            markers, healthy, non_healthy = marker_columns(
+                included, healthy, non_healthy, species)
+            samples = _sample_positions(biom_file, sample_ids)
+            projected, totals = _read_marker_projection(
+                biom_file, included, markers, samples, self.dtype)
+            sample_ids = _read_ids(biom_file, 'sample')
+            if samples is not None:
+                sample_ids = sample_ids[samples]
+
+        gmhi = gmhi_projected(projected, totals, healthy, non_healthy,
+                              *self.parameters)
+        return pd.Series(gmhi, index=sample_ids, name='GMHI')
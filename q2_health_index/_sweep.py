@@ -0,0 +1,136 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import itertools
+import os
+
+import biom
+import pandas as pd
+
+from q2_health_index import _kernel
+from q2_health_index._scorer import _species_masks
+from q2_health_index._utilities import _load_and_validate_species
+
+# Samples rendered in index.html, the full table is only in the TSV
+PREVIEW_SAMPLES = 100
+
+
+def _project_markers(table: biom.Table = None,
+                     healthy_species_list: list = None,
+                     non_healthy_species_list: list = None):
+    # Relative frequencies are not needed, because markers are
+    # re-normalized with the totals anyway
+    included, healthy, non_healthy, _ = _species_masks(
+        table.ids(axis='observation'), healthy_species_list,
+        non_healthy_species_list)
+    markers, healthy, non_healthy = _kernel.marker_columns(
+        included, healthy, non_healthy)
+    return (*_kernel.project_sparse(table.matrix_data.T, included, markers),
+            healthy, non_healthy)
+
+
+def _write_table_visualization(output_dir: str, table: pd.DataFrame,
+                               title: str, filename: str,
+                               preview_samples: int = PREVIEW_SAMPLES):
+    """
+    Write the table as a TSV download and a preview of its rows of the
+    first `preview_samples` samples as index.html
+    """
+    table.to_csv(os.path.join(output_dir, filename), sep='\t')
+    sample_ids = table.index.unique()
+    preview = table[table.index.isin(sample_ids[:preview_samples])]
+    with open(os.path.join(output_dir, 'index.html'), 'w') as fh:
+        fh.write(f'<html><body>\n'
+                 f'<h1>{title}</h1>\n'
+                 f'<p><a href="{filename}">Download as TSV</a></p>\n')
+        if len(sample_ids) > preview_samples:
+            fh.write(f'<p>Showing the first {preview_samples} of '
+                     f'{len(sample_ids)} samples, all samples are in the '
+                     f'TSV.</p>\n')
+        fh.write(preview.to_html())
+        fh.write('\n</body></html>\n')
+
+
+def _sweep_df(table: biom.Table = None,
+              healthy_species_list: list = None,
+              non_healthy_species_list: list = None,
+              mh_primes: list = None,
+              mn_primes: list = None,
+              rel_threshs: list = None,
+              log_threshs: list = None):
+    grid = (mh_primes or [7], mn_primes or [31],
+            rel_threshs or [0.00001], log_threshs or [0.00001])
+
+    # Parsing, projection and re-normalization are shared by all the
+    # combinations
+    gmhi = _kernel.gmhi_sweep(
+        *_project_markers(table, healthy_species_list,
+                          non_healthy_species_list), *grid)
+
+    columns = [f'mh_prime={mh};mn_prime={mn};rel_thresh={rt};log_thresh={lt}'
+               for mh, mn, rt, lt in itertools.product(*grid)]
+    return pd.DataFrame(gmhi, index=pd.Index(table.ids(axis='sample'),
+                                             name='sample-id'),
+                        columns=columns)
+
+
+def _rel_thresh_curve_df(table: biom.Table = None,
+                         healthy_species_list: list = None,
+                         non_healthy_species_list: list = None,
+                         mh_prime: int = 7,
+                         mn_prime: int = 31,
+                         log_thresh: float = 0.00001):
+    samples, lower, upper, gmhi = _kernel.gmhi_rel_thresh_curve(
+        *_project_markers(table, healthy_species_list,
+                          non_healthy_species_list),
+        mh_prime, mn_prime, log_thresh)
+
+    sample_ids = pd.Index(table.ids(axis='sample'), name='sample-id')
+    return pd.DataFrame({'rel_thresh_from': lower,
+                         'rel_thresh_to': upper,
+                         'GMHI': gmhi}, index=sample_ids[samples])
+
+
+def gmhi_sweep(output_dir: str,
+               table: biom.Table,
+               healthy_species_fp: str = None,
+               non_healthy_species_fp: str = None,
+               mh_primes: list = None,
+               mn_primes: list = None,
+               rel_threshs: list = None,
+               log_threshs: list = None) -> None:
+    # Load and validate species lists
+    healthy_species_list, non_healthy_species_list = \
+        _load_and_validate_species(healthy_species_fp, non_healthy_species_fp)
+
+    sweep_df = _sweep_df(table, healthy_species_list,
+                         non_healthy_species_list, mh_primes, mn_primes,
+                         rel_threshs, log_threshs)
+
+    _write_table_visualization(output_dir, sweep_df, 'GMHI parameter sweep',
+                               'gmhi_sweep.tsv')
+
+
+def gmhi_rel_thresh_curve(output_dir: str,
+                          table: biom.Table,
+                          healthy_species_fp: str = None,
+                          non_healthy_species_fp: str = None,
+                          mh_prime: int = 7,
+                          mn_prime: int = 31,
+                          log_thresh: float = 0.00001) -> None:
+    # Load and validate species lists
+    healthy_species_list, non_healthy_species_list = \
+        _load_and_validate_species(healthy_species_fp, non_healthy_species_fp)
+
+    curve_df = _rel_thresh_curve_df(table, healthy_species_list,
+                                    non_healthy_species_list, mh_prime,
+                                    mn_prime, log_thresh)
+
+    _write_table_visualization(output_dir, curve_df,
+                               'GMHI as a function of rel_thresh',
+                               'gmhi_rel_thresh_curve.tsv')
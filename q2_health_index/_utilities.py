@@ -38,6 +38,11 @@ def _load_file(file: str = None):
         return list(map(lambda x: x.strip(), f.readlines()))
 
 
+def _parse_species(feature_ids: pd.Index = None):
+    # Keep only the last (species) level of the full taxonomy
+    return pd.Index(feature_ids).str.split(';').str[-1].str.strip()
+
+
 def _load_metadata(metadata: Metadata = None):
     if not metadata:
         raise ValueError('Metadata parameter not provided!')
@@ -45,9 +50,30 @@ def _load_metadata(metadata: Metadata = None):
     return metadata
 
 
+def _select_sample_ids(metadata: Metadata = None, where: str = None):
+    # Samples are only selected if a where clause is provided
+    if not where:
+        return None
+    if not metadata:
+        raise ValueError('Metadata parameter not provided!')
+    return metadata.get_ids(where)
+
+
+def _validate_unique_sample_ids(sample_ids: list = None):
+    # Sample IDs of every table, which must not repeat across the tables
+    sample_ids = pd.Index([sample_id for table_ids in sample_ids
+                           for sample_id in table_ids])
+    duplicated = sample_ids[sample_ids.duplicated()].unique()
+    if len(duplicated) > 0:
+        raise ValueError(f'{len(duplicated)} sample ID(s) present in more '
+                         f'than one feature table, e.g.: '
+                         f'{", ".join(map(str, duplicated[:5]))}')
+
+
 # Borrowed from q2_longitudinal
 def _validate_metadata_is_superset(metadata: pd.DataFrame = None,
                                    table: pd.DataFrame = None):
+    # Only the sample index of the table (DataFrame or Series) is used
     metadata_ids = set(metadata.index.tolist())
     table_ids = set(table.index.tolist())
     missing_ids = table_ids.difference(metadata_ids)
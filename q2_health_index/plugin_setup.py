@@ -8,9 +8,14 @@
 
 import q2_health_index
 
-from q2_health_index._gmhi import gmhi_predict, gmhi_predict_viz
-from qiime2.plugin import (Int, Str, Float, Plugin, Citations, Metadata,
-                           Visualization)
+from q2_health_index._gmhi import (calculate_gmhi, calculate_gmhi_batch,
+                                   gmhi_predict, gmhi_predict_viz)
+from q2_health_index._metaphlan import (calculate_gmhi_metaphlan,
+                                        calculate_gmhi_metaphlan_profiles)
+from q2_health_index._sweep import gmhi_rel_thresh_curve, gmhi_sweep
+from qiime2.plugin import (Bool, Choices, Int, Str, Float, List, Range,
+                           Plugin, Citations, Metadata, Visualization)
+from q2_types.feature_data import FeatureData, Taxonomy
 from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
 from q2_types.sample_data import SampleData, AlphaDiversity
 
@@ -22,6 +27,10 @@ basic_parameters = {
         'mn_prime': Int,
         'rel_thresh': Float,
         'log_thresh': Float,
+        'chunk_size': Int % Range(1, None),
+        'n_jobs': Int % Range(1, None),
+        'collapse_species': Bool,
+        'dtype': Str % Choices(['float64', 'float32']),
     }
 
 basic_parameters_descriptions = {
@@ -37,6 +46,60 @@ basic_parameters_descriptions = {
                       'insignificant OTU.',
         'log_thresh': 'Normalization value for log10 in the last step of '
                       'GMHI calculation.',
+        'chunk_size': 'Number of samples read and scored at once. If not '
+                      'provided, all samples are read at once.',
+        'n_jobs': 'Number of processes used to score shards of samples in '
+                  'parallel.',
+        'collapse_species': 'Sum features assigned to the same species '
+                            '(e.g. ASVs of a full-taxonomy table) before '
+                            'calculating GMHI, instead of treating them as '
+                            'separate species.',
+        'dtype': 'Floating point precision of the abundances. float32 '
+                 'lowers the peak memory of chunked scoring, sums are '
+                 'accumulated in float64 either way. GMHI usually agrees '
+                 'with float64 to 6 decimal places, but abundances within '
+                 'float32 rounding of rel_thresh may be thresholded '
+                 'differently, which changes GMHI more (see README).',
+    }
+
+taxonomy_input_description = (
+    'Taxonomy of the features of the table. If provided, feature IDs '
+    '(e.g. ASV hashes of a DADA2 table) are replaced with their taxonomy '
+    'before species are extracted, otherwise feature IDs are expected to '
+    'hold the taxonomy. Every feature of the table must be present.')
+
+where_parameter_description = (
+    'SQLite WHERE clause specifying sample metadata criteria that must be '
+    'met for a sample to be scored. Only the matching samples are read from '
+    'the feature table. If not provided, all samples are scored.')
+
+cache_parameters = {
+        'cache_dir': Str,
+        'cache_max_size': Int % Range(1, None),
+        'incremental_fp': Str,
+        'incremental_detect_changes': Bool,
+    }
+
+cache_parameters_descriptions = {
+        'cache_dir': 'Directory of the on-disk cache of GMHI results, keyed '
+                     'by the input table UUID, species lists and GMHI '
+                     'parameters. If not provided, caching is disabled.',
+        'cache_max_size': 'Maximal size of the cache directory in megabytes '
+                          '(results and parsed feature labels), least '
+                          'recently used files are evicted first.',
+        'incremental_fp': 'TSV file of previous GMHI results with per-sample '
+                          'row hashes. Only samples not in the file are '
+                          'scored and the file is updated with them. Created '
+                          'if it does not exist. The cache (cache_dir) is '
+                          'not used with it.',
+        'incremental_detect_changes': 'Also score samples of incremental_fp '
+                                      'whose abundances changed (compared '
+                                      'by row hashes). Reads every '
+                                      'abundance of the table, so it costs '
+                                      'about as much as scoring all '
+                                      'samples. Without it, reusing '
+                                      'results calculated from another '
+                                      'table warns.',
     }
 
 plugin = Plugin(
@@ -52,16 +115,141 @@ plugin = Plugin(
                       'Index (GMHI).'
 )
 
+plugin.methods.register_function(
+    function=calculate_gmhi,
+    inputs={'table': FeatureTable[Frequency | RelativeFrequency],
+            'taxonomy': FeatureData[Taxonomy]},
+    parameters={key: basic_parameters[key] for key in basic_parameters
+                if key != 'chunk_size'},
+    outputs=[
+        ('gmhi_results', SampleData[AlphaDiversity]),
+    ],
+    input_descriptions={'table': 'The feature frequency table to calculate '
+                                 'Gut Microbiome Health Index from.',
+                        'taxonomy': taxonomy_input_description},
+    parameter_descriptions={key: basic_parameters_descriptions[key]
+                            for key in basic_parameters
+                            if key != 'chunk_size'},
+    output_descriptions={
+        'gmhi_results': 'Calculated GMHI in tabular form.',
+    },
+    name='Calculate GMHI (method)',
+    description='Calculate Gut Microbial Health Index based on input data. '
+                'The whole table is scored in memory, without sample '
+                'selection, caching or incremental scoring (see '
+                'gmhi-predict).'
+)
+
+plugin.methods.register_function(
+    function=calculate_gmhi_batch,
+    inputs={'tables': List[FeatureTable[Frequency | RelativeFrequency]],
+            'taxonomy': FeatureData[Taxonomy]},
+    parameters={key: basic_parameters[key] for key in basic_parameters
+                if key != 'chunk_size'},
+    outputs=[
+        ('gmhi_results', SampleData[AlphaDiversity]),
+    ],
+    input_descriptions={'tables': 'The feature frequency tables to calculate '
+                                  'Gut Microbiome Health Index from. Sample '
+                                  'IDs must be unique across the tables.',
+                        'taxonomy': taxonomy_input_description},
+    parameter_descriptions={
+        **{key: basic_parameters_descriptions[key] for key in basic_parameters
+           if key not in ('chunk_size', 'n_jobs')},
+        'n_jobs': 'Number of processes used to score the tables in '
+                  'parallel.',
+    },
+    output_descriptions={
+        'gmhi_results': 'Calculated GMHI of the samples of all the tables '
+                        'in tabular form.',
+    },
+    name='Calculate GMHI of many tables',
+    description='Calculate Gut Microbial Health Index of many feature '
+                'tables (e.g. one per sequencing run) in one call, merged '
+                'into a single result. The species lists are loaded once '
+                'and the labels of tables sharing features are parsed once.'
+)
+
+plugin.methods.register_function(
+    function=calculate_gmhi_metaphlan,
+    inputs={},
+    parameters={
+        'metaphlan_table_fp': Str,
+        **{key: basic_parameters[key] for key in
+           ['healthy_species_fp', 'non_healthy_species_fp', 'mh_prime',
+            'mn_prime', 'rel_thresh', 'log_thresh']},
+    },
+    outputs=[
+        ('gmhi_results', SampleData[AlphaDiversity]),
+    ],
+    parameter_descriptions={
+        'metaphlan_table_fp': 'Path to MetaPhlAn merged abundance table '
+                              '(clades x samples) [REQUIRED].',
+        **{key: basic_parameters_descriptions[key] for key in
+           ['healthy_species_fp', 'non_healthy_species_fp', 'mh_prime',
+            'mn_prime', 'rel_thresh', 'log_thresh']},
+    },
+    output_descriptions={
+        'gmhi_results': 'Calculated GMHI in tabular form.',
+    },
+    name='Calculate GMHI from MetaPhlAn table',
+    description='Calculate Gut Microbial Health Index directly from '
+                'a MetaPhlAn merged abundance table, without converting it '
+                'to a feature table first. Only species-level rows are '
+                'used, strain-level (t__) rows are skipped.'
+)
+
+plugin.methods.register_function(
+    function=calculate_gmhi_metaphlan_profiles,
+    inputs={},
+    parameters={
+        'metaphlan_profiles_dir': Str,
+        'profile_suffix': Str,
+        **{key: basic_parameters[key] for key in
+           ['healthy_species_fp', 'non_healthy_species_fp', 'mh_prime',
+            'mn_prime', 'rel_thresh', 'log_thresh', 'n_jobs']},
+    },
+    outputs=[
+        ('gmhi_results', SampleData[AlphaDiversity]),
+    ],
+    parameter_descriptions={
+        'metaphlan_profiles_dir': 'Path to directory with one MetaPhlAn '
+                                  'profile per sample [REQUIRED].',
+        'profile_suffix': 'Suffix of the profile file names, sample IDs are '
+                          'the file names without it.',
+        **{key: basic_parameters_descriptions[key] for key in
+           ['healthy_species_fp', 'non_healthy_species_fp', 'mh_prime',
+            'mn_prime', 'rel_thresh', 'log_thresh']},
+        'n_jobs': 'Number of processes used to parse and score profiles in '
+                  'parallel.',
+    },
+    output_descriptions={
+        'gmhi_results': 'Calculated GMHI in tabular form.',
+    },
+    name='Calculate GMHI from MetaPhlAn profiles',
+    description='Calculate Gut Microbial Health Index from a directory of '
+                'single-sample MetaPhlAn profiles, without merging them '
+                'into one table. Profiles that cannot be parsed are '
+                'reported and their samples are skipped.'
+)
+
 plugin.pipelines.register_function(
     function=gmhi_predict,
-    inputs={'table': FeatureTable[Frequency | RelativeFrequency]},
-    parameters=basic_parameters,
+    inputs={'table': FeatureTable[Frequency | RelativeFrequency],
+            'taxonomy': FeatureData[Taxonomy]},
+    parameters={**basic_parameters, **cache_parameters,
+                'metadata': Metadata, 'where': Str},
     outputs=[
         ('gmhi_results', SampleData[AlphaDiversity]),
     ],
     input_descriptions={'table': 'The feature frequency table to calculate '
-                                 'Gut Microbiome Health Index from.'},
-    parameter_descriptions=basic_parameters_descriptions,
+                                 'Gut Microbiome Health Index from.',
+                        'taxonomy': taxonomy_input_description},
+    parameter_descriptions={**basic_parameters_descriptions,
+                            **cache_parameters_descriptions,
+                            'metadata': 'Sample metadata used with the where '
+                                        'parameter to select samples.',
+                            'where': where_parameter_description},
     output_descriptions={
         'gmhi_results': 'Calculated GMHI in tabular form.',
     },
@@ -73,10 +261,13 @@ plugin.pipelines.register_function(
     function=gmhi_predict_viz,
     inputs={
         'table': FeatureTable[Frequency | RelativeFrequency],
+        'taxonomy': FeatureData[Taxonomy],
     },
     parameters={
         **basic_parameters,
+        **cache_parameters,
         'metadata': Metadata,
+        'where': Str,
     },
     outputs=[
         ('gmhi_results', SampleData[AlphaDiversity]),
@@ -84,10 +275,13 @@ plugin.pipelines.register_function(
     ],
     input_descriptions={'table': 'The feature frequency table to calculate '
                                  'Gut Microbiome Health Index from.',
+                        'taxonomy': taxonomy_input_description,
                         },
     parameter_descriptions={
         **basic_parameters_descriptions,
+        **cache_parameters_descriptions,
         'metadata': 'Metadata used for visualization [REQUIRED].',
+        'where': where_parameter_description,
     },
     output_descriptions={
         'gmhi_results': 'Calculated GMHI in tabular form.',
@@ -97,3 +291,59 @@ plugin.pipelines.register_function(
     description='Calculate and plot Gut Microbial Health Index based on '
                 'input data and metadata. '
 )
+
+plugin.visualizers.register_function(
+    function=gmhi_sweep,
+    inputs={'table': FeatureTable[Frequency | RelativeFrequency]},
+    parameters={
+        'healthy_species_fp': Str,
+        'non_healthy_species_fp': Str,
+        'mh_primes': List[Int],
+        'mn_primes': List[Int],
+        'rel_threshs': List[Float],
+        'log_threshs': List[Float],
+    },
+    input_descriptions={'table': 'The feature frequency table to calculate '
+                                 'Gut Microbiome Health Index from.'},
+    parameter_descriptions={
+        'healthy_species_fp':
+            basic_parameters_descriptions['healthy_species_fp'],
+        'non_healthy_species_fp':
+            basic_parameters_descriptions['non_healthy_species_fp'],
+        'mh_primes': 'Values of mh_prime to sweep over [default: 7].',
+        'mn_primes': 'Values of mn_prime to sweep over [default: 31].',
+        'rel_threshs': 'Values of rel_thresh to sweep over '
+                       '[default: 0.00001].',
+        'log_threshs': 'Values of log_thresh to sweep over '
+                       '[default: 0.00001].',
+    },
+    name='GMHI parameter sweep',
+    description='Calculate Gut Microbial Health Index for every combination '
+                'of mh_prime, mn_prime, rel_thresh and log_thresh values in '
+                'a single pass, resulting in a table with one column per '
+                'combination.'
+)
+
+plugin.visualizers.register_function(
+    function=gmhi_rel_thresh_curve,
+    inputs={'table': FeatureTable[Frequency | RelativeFrequency]},
+    parameters={
+        'healthy_species_fp': Str,
+        'non_healthy_species_fp': Str,
+        'mh_prime': Int,
+        'mn_prime': Int,
+        'log_thresh': Float,
+    },
+    input_descriptions={'table': 'The feature frequency table to calculate '
+                                 'Gut Microbiome Health Index from.'},
+    parameter_descriptions={
+        key: basic_parameters_descriptions[key] for key in
+        ['healthy_species_fp', 'non_healthy_species_fp', 'mh_prime',
+         'mn_prime', 'log_thresh']
+    },
+    name='GMHI as a function of rel_thresh',
+    description='Calculate the exact, piecewise constant Gut Microbial '
+                'Health Index of every sample for all values of rel_thresh. '
+                'Each row of the resulting table holds GMHI for '
+                'rel_thresh_from < rel_thresh <= rel_thresh_to.'
+)
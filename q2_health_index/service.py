@@ -0,0 +1,378 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2020-2021, Bioinformatics at Małopolska Centre of Biotechnology
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import biom
+import numpy as np
+import pandas as pd
+
+from q2_health_index._scorer import GMHIScorer
+
+__all__ = ['GMHIClient', 'benchmark', 'make_server']
+
+DEFAULT_PANEL = 'default'
+REQUEST_TIMEOUT = 30
+
+
+class _MicroBatcher:
+    """
+    Coalesce concurrent scoring requests into micro-batches
+
+    Requests are queued by the HTTP handler threads and a single worker
+    scores them, waiting at most `max_delay` seconds for more requests to
+    arrive, up to `max_batch_size` samples. Requests of the same panel and
+    feature space are stacked and scored with one kernel call.
+    """
+
+    def __init__(self, scorers: dict = None, max_batch_size: int = 1024,
+                 max_delay: float = 0.002):
+        self.scorers = scorers
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.n_requests = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, panel: str = DEFAULT_PANEL,
+               abundances: np.ndarray = None,
+               feature_ids: tuple = None) -> Future:
+        if panel not in self.scorers:
+            raise KeyError(f'Unknown panel \'{panel}\', available panels: '
+                           f'{", ".join(self.scorers)}')
+        future = Future()
+        self._queue.put((panel, tuple(feature_ids), abundances, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, first: tuple):
+        batch, n_samples = [first], len(first[2])
+        deadline = time.monotonic() + self.max_delay
+        while n_samples < self.max_batch_size:
+            try:
+                request = self._queue.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                # Put the sentinel back for the main loop
+                self._queue.put(None)
+                break
+            batch.append(request)
+            n_samples += len(request[2])
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            try:
+                groups = {}
+                for panel, feature_ids, abundances, future in batch:
+                    groups.setdefault((panel, feature_ids), []).append(
+                        (abundances, future))
+                for (panel, feature_ids), requests in groups.items():
+                    self._score(panel, feature_ids, requests)
+            except Exception as error:
+                # Only the requests of this batch fail, the worker keeps
+                # serving the next ones
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _score(self, panel: str, feature_ids: tuple, requests: list):
+        abundances, futures = zip(*requests)
+        try:
+            gmhi = self.scorers[panel].score(np.vstack(abundances),
+                                             feature_ids)
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+            return
+        self.n_requests += len(requests)
+        self.n_batches += 1
+        bounds = np.cumsum([0] + [len(rows) for rows in abundances])
+        for future, start, stop in zip(futures, bounds[:-1], bounds[1:]):
+            future.set_result(gmhi[start:stop])
+
+
+def _parse_payload(payload: dict):
+    """
+    Validate a JSON scoring request: feature IDs, a samples x features
+    `abundances` matrix and optional sample IDs and panel name
+    """
+    feature_ids = payload['feature_ids']
+    if not isinstance(feature_ids, list) or \
+            not all(isinstance(i, str) for i in feature_ids):
+        raise TypeError('Feature IDs must be a list of strings.')
+    panel = payload.get('panel', DEFAULT_PANEL)
+    if not isinstance(panel, str):
+        raise TypeError('Panel must be a string.')
+    abundances = np.asarray(payload['abundances'], dtype=np.float64)
+    if abundances.ndim != 2 or abundances.shape[1] != len(feature_ids):
+        raise ValueError(f'Abundances must be a samples x features matrix '
+                         f'with {len(feature_ids)} columns, got shape '
+                         f'{abundances.shape}.')
+    sample_ids = payload.get('sample_ids') or list(range(len(abundances)))
+    if not isinstance(sample_ids, list):
+        raise TypeError('Sample IDs must be a list.')
+    if len(sample_ids) != len(abundances):
+        raise ValueError(f'{len(sample_ids)} sample IDs provided for '
+                         f'{len(abundances)} samples.')
+    return panel, feature_ids, abundances, sample_ids
+
+
+class _GMHIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would
+    # delay the body until the client acknowledges the headers
+    disable_nagle_algorithm = True
+
+    def _respond(self, status: int, body: dict):
+        content = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._respond(404, {'error': f'Unknown path {self.path}'})
+            return
+        batcher = self.server.batcher
+        self._respond(200, {'panels': sorted(batcher.scorers),
+                            'requests': batcher.n_requests,
+                            'batches': batcher.n_batches})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._respond(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            panel, feature_ids, abundances, sample_ids = \
+                _parse_payload(json.loads(self.rfile.read(length)))
+            gmhi = self.server.batcher.submit(panel, abundances,
+                                              feature_ids).result(
+                self.server.request_timeout)
+        except (KeyError, ValueError, TypeError, AssertionError) as error:
+            self._respond(400, {'error': f'{type(error).__name__}: {error}'})
+            return
+        except TimeoutError:
+            self._respond(503, {'error': 'Scoring timed out after '
+                                         f'{self.server.request_timeout} s.'})
+            return
+        self._respond(200, {'sample_ids': sample_ids, 'gmhi': gmhi.tolist()})
+
+    def log_message(self, format, *args):
+        # Requests are not logged, the service is meant for tight loops
+        pass
+
+
+def make_server(scorers: dict = None, host: str = '127.0.0.1',
+                port: int = 0, max_batch_size: int = 1024,
+                max_delay: float = 0.002,
+                request_timeout: float = REQUEST_TIMEOUT) \
+        -> ThreadingHTTPServer:
+    """
+    Create a GMHI scoring HTTP server with warm {name: GMHIScorer} panels
+    (the bundled panel as 'default' if none are given)
+
+    POST /score takes {"feature_ids": [...], "abundances": [[...], ...],
+    "sample_ids": [...], "panel": "default"} (samples x features) and
+    returns {"sample_ids": [...], "gmhi": [...]}. GET /health lists the
+    panels and the micro-batching statistics. Use port 0 to bind any free
+    port, the bound address is `server.server_address`. Requests not
+    scored within `request_timeout` seconds get a 503 response.
+    """
+    server = ThreadingHTTPServer((host, port), _GMHIRequestHandler)
+    server.daemon_threads = True
+    server.batcher = _MicroBatcher(scorers or {DEFAULT_PANEL: GMHIScorer()},
+                                   max_batch_size, max_delay)
+    server.request_timeout = request_timeout
+    return server
+
+
+class GMHIClient:
+    """
+    Client of the GMHI scoring service, keeping one connection open
+
+    Not thread-safe, concurrent callers should use one client each.
+    """
+
+    def __init__(self, url: str = 'http://127.0.0.1:8765'):
+        url = urllib.parse.urlsplit(url)
+        self._connection = http.client.HTTPConnection(url.hostname,
+                                                      url.port)
+
+    def _request(self, method: str, path: str, body: dict = None):
+        self._connection.request(
+            method, path,
+            body=None if body is None else json.dumps(body),
+            headers={'Content-Type': 'application/json'})
+        response = self._connection.getresponse()
+        content = json.loads(response.read())
+        if response.status != 200:
+            raise ValueError(content['error'])
+        return content
+
+    def health(self) -> dict:
+        return self._request('GET', '/health')
+
+    def score(self, abundances, feature_ids: list = None,
+              sample_ids: list = None,
+              panel: str = DEFAULT_PANEL) -> pd.Series:
+        """
+        Calculate GMHI of every row (sample) of a samples x features
+        abundance matrix (or DataFrame, labeled with sample and feature
+        IDs)
+        """
+        if isinstance(abundances, pd.DataFrame):
+            feature_ids = feature_ids or list(abundances.columns)
+            sample_ids = sample_ids or list(abundances.index)
+        content = self._request('POST', '/score', {
+            'panel': panel, 'feature_ids': list(feature_ids),
+            'abundances': np.asarray(abundances).tolist(),
+            'sample_ids': None if sample_ids is None else list(sample_ids)})
+        return pd.Series(content['gmhi'], index=content['sample_ids'],
+                         name='GMHI')
+
+    def close(self):
+        self._connection.close()
+
+
+def benchmark(url: str = None, abundances: pd.DataFrame = None,
+              n_requests: int = 1000, concurrency: int = 8,
+              batch_size: int = 4) -> dict:
+    """
+    Send `n_requests` requests of `batch_size` samples (rows of
+    `abundances`) from `concurrency` clients, returning latency
+    percentiles in milliseconds and the throughput in samples per second
+    """
+    def run(n: int):
+        client, latencies = GMHIClient(url), []
+        try:
+            for i in range(n):
+                start = (i * batch_size) % max(len(abundances) - batch_size,
+                                               1)
+                batch = abundances.iloc[start:start + batch_size]
+                began = time.perf_counter()
+                client.score(batch)
+                latencies.append(time.perf_counter() - began)
+        finally:
+            client.close()
+        return latencies
+
+    shares = [n_requests // concurrency + (i < n_requests % concurrency)
+              for i in range(concurrency)]
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.concatenate(list(executor.map(run, shares))) * 1000
+    elapsed = time.perf_counter() - began
+    return {'requests': n_requests,
+            'concurrency': concurrency,
+            'batch_size': batch_size,
+            'p50_ms': np.percentile(latencies, 50),
+            'p95_ms': np.percentile(latencies, 95),
+            'p99_ms': np.percentile(latencies, 99),
+            'samples_per_s': n_requests * batch_size / elapsed}
+
+
+def _parse_panels(panels: list = None, **parameters):
+    # NAME=HEALTHY_FP,NON_HEALTHY_FP
+    scorers = {}
+    for panel in panels or []:
+        name, _, fps = panel.partition('=')
+        healthy_species_fp, _, non_healthy_species_fp = fps.partition(',')
+        scorers[name] = GMHIScorer(healthy_species_fp or None,
+                                   non_healthy_species_fp or None,
+                                   **parameters)
+    return scorers or {DEFAULT_PANEL: GMHIScorer(**parameters)}
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        prog='python -m q2_health_index.service',
+        description='Long-running GMHI scoring service with warm marker '
+                    'panels, and its latency/throughput benchmark.')
+    parser.add_argument('command', choices=['serve', 'benchmark'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--panel', action='append', metavar='NAME=MH,MN',
+                        help='Named panel of healthy and non-healthy '
+                             'species files, may be repeated [default: '
+                             'the bundled panel as \'default\'].')
+    parser.add_argument('--mh-prime', type=int, default=7)
+    parser.add_argument('--mn-prime', type=int, default=31)
+    parser.add_argument('--rel-thresh', type=float, default=0.00001)
+    parser.add_argument('--log-thresh', type=float, default=0.00001)
+    parser.add_argument('--max-batch-size', type=int, default=1024)
+    parser.add_argument('--max-delay', type=float, default=0.002,
+                        help='Seconds to wait for more requests to batch.')
+    parser.add_argument('--request-timeout', type=float,
+                        default=REQUEST_TIMEOUT,
+                        help='Seconds to wait for a request to be scored '
+                             'before responding with 503.')
+    parser.add_argument('--table', help='BIOM table to benchmark with.')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    scorers = _parse_panels(args.panel, mh_prime=args.mh_prime,
+                            mn_prime=args.mn_prime,
+                            rel_thresh=args.rel_thresh,
+                            log_thresh=args.log_thresh)
+    server = make_server(scorers, args.host,
+                         args.port if args.command == 'serve' else 0,
+                         args.max_batch_size, args.max_delay,
+                         args.request_timeout)
+    host, port = server.server_address[:2]
+    if args.command == 'serve':
+        print(f'Serving GMHI on http://{host}:{port} '
+              f'(panels: {", ".join(scorers)})')
+        try:
+            server.serve_forever()
+        finally:
+            server.batcher.close()
+        return
+
+    table = biom.load_table(args.table)
+    abundances = table.to_dataframe(dense=True).T
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        result = benchmark(f'http://{host}:{port}', abundances,
+                           args.requests, args.concurrency, args.batch_size)
+        result['batches'] = server.batcher.n_batches
+    finally:
+        server.shutdown()
+        server.batcher.close()
+    for key, value in result.items():
+        print(f'{key}: {value:.2f}' if isinstance(value, float)
+              else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,47 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
+import os
+import tempfile
+import threading
 import unittest
-from warnings import filterwarnings
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from warnings import catch_warnings, filterwarnings
 
+import biom
+import h5py
+import numpy as np
+import numpy.testing as npt
 import pandas as pd
 import pandas.testing as pdt
 import qiime2
+from scipy import sparse
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins import health_index
 
+from q2_health_index import _qza
+from q2_health_index._async_batch import gmhi_from_qzas
+from q2_health_index._biom_reader import _read_marker_projection, _row_sums
+from q2_health_index._gmhi import calculate_gmhi_batch, gmhi_from_qza
+from q2_health_index._incremental import (_load_incremental, _row_hashes,
+                                          _score_incremental,
+                                          _store_incremental)
+from q2_health_index._cache import _cache_key, _cache_load, _cache_store
+from q2_health_index._labels import (_LABEL_INDEX_CACHE, _label_index,
+                                     _taxonomy_labels)
+from q2_health_index._metaphlan import (_read_metaphlan_profile,
+                                        calculate_gmhi_metaphlan,
+                                        calculate_gmhi_metaphlan_profiles)
+from q2_health_index._kernel import (gmhi_dense, gmhi_projected,
+                                     gmhi_rel_thresh_curve, gmhi_sparse,
+                                     gmhi_sweep, marker_columns,
+                                     project_dense, project_sparse)
+from q2_health_index._scorer import GMHIScorer
+from q2_health_index.service import GMHIClient, make_server
+from q2_health_index._sweep import (_rel_thresh_curve_df, _sweep_df,
+                                    _write_table_visualization)
 from q2_health_index._utilities import (_load_file,
                                         _load_metadata,
                                         _load_and_validate_species,
@@ -27,6 +59,8 @@ filterwarnings("ignore", category=RuntimeWarning)
 
 HEALTHY_SPECIES_DEFAULT = _load_file(HEALTHY_SPECIES_DEFAULT_FP)
 NON_HEALTHY_SPECIES_DEFAULT = _load_file(NON_HEALTHY_SPECIES_DEFAULT_FP)
+FULL_TAXONOMY_TABLE_FP = ("input/abundances"
+                          "/full_taxonomy_mock_feature_table.qza")
 
 
 class TestUtilities(TestPluginBase):
@@ -113,6 +147,14 @@ class TestUtilities(TestPluginBase):
         metadata_new = _validate_metadata_is_superset(metadata, table)
         self.assertListEqual(sorted(metadata_new.index), sorted(table.index))
 
+    def test_metadata_validate_gmhi_series(self):
+        metadata_file = self.get_data_path(
+            'input/metadata/simple_metadata.tsv')
+        metadata = _load_metadata(qiime2.Metadata.load(metadata_file))
+        gmhi = pd.Series(0.0, index=metadata.index[:2], name='GMHI')
+        metadata_new = _validate_metadata_is_superset(metadata, gmhi)
+        self.assertListEqual(sorted(metadata_new.index), sorted(gmhi.index))
+
     def test_metadata_validate_simple_wrong(self):
         with self.assertRaisesRegex(ValueError,
                                     "Missing samples in metadata: {'MOCK-"):
@@ -124,6 +166,803 @@ class TestUtilities(TestPluginBase):
             _validate_metadata_is_superset(metadata, table)
 
 
+class TestKernel(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def test_gmhi_dense_simple(self):
+        abundances = np.array([[0.2, 0.3, 0.1, 0.4],
+                               [0.6, 0.2, 0.0, 0.2],
+                               [0.0, 0.0, 0.0, 1.0]])
+        included = np.array([True, True, True, False])
+        healthy = np.array([True, False, False, False])
+        non_healthy = np.array([False, True, True, False])
+        gmhi = gmhi_dense(abundances, included, healthy, non_healthy,
+                          mh_prime=1, mn_prime=1)
+        mh = 0.2 / 0.6
+        mn = np.array([0.3, 0.1]) / 0.6
+        psi_mh = -mh * np.log(mh)
+        psi_mn = -2 * np.sum(mn * np.log(mn))
+        npt.assert_allclose(gmhi, [
+            np.log10((psi_mh + 1e-5) / (psi_mn + 1e-5)),
+            np.log10((-0.75 * np.log(0.75) + 1e-5) /
+                     (-0.25 * np.log(0.25) + 1e-5)),
+            # No classified species left after re-normalization
+            0.0])
+
+    def test_gmhi_sparse_equals_dense(self):
+        abundances = np.array([[0.2, 0.3, 0.1, 0.4, 0.0],
+                               [0.6, 0.2, 0.0, 0.2, 0.0],
+                               [0.0, 0.0, 0.0, 1.0, 0.0],
+                               [0.0, 0.5, 0.5, 0.0, 0.000001]])
+        included = np.array([True, True, True, False, True])
+        healthy = np.array([True, False, False, False, False])
+        non_healthy = np.array([False, True, True, False, True])
+        npt.assert_allclose(
+            gmhi_sparse(sparse.csr_matrix(abundances), included, healthy,
+                        non_healthy),
+            gmhi_dense(abundances, included, healthy, non_healthy))
+
+    def test_gmhi_invariant_to_sample_scaling(self):
+        # Frequencies and relative frequencies give the same result
+        counts = np.array([[20, 30, 10, 40, 0],
+                           [600, 200, 0, 200, 1]])
+        included = np.array([True, True, True, False, True])
+        healthy = np.array([True, False, False, False, False])
+        non_healthy = np.array([False, True, True, False, True])
+        npt.assert_allclose(
+            gmhi_sparse(sparse.csr_matrix(counts), included, healthy,
+                        non_healthy),
+            gmhi_sparse(sparse.csr_matrix(
+                counts / counts.sum(axis=1, keepdims=True)), included,
+                healthy, non_healthy))
+
+    def test_project(self):
+        abundances = np.array([[0.2, 0.3, 0.1, 0.4],
+                               [0.6, 0.2, 0.0, 0.2]])
+        included = np.array([True, True, True, False])
+        markers = np.array([0, 2])
+        dense_markers, dense_totals = \
+            project_dense(abundances, included, markers)
+        sparse_markers, sparse_totals = \
+            project_sparse(sparse.csr_matrix(abundances), included, markers)
+        npt.assert_allclose(dense_markers, [[0.2, 0.1], [0.6, 0.0]])
+        npt.assert_allclose(sparse_markers.toarray(), dense_markers)
+        npt.assert_allclose(dense_totals, [0.6, 0.8])
+        npt.assert_allclose(sparse_totals, dense_totals)
+
+    def test_gmhi_collapse_species(self):
+        # Features 0 and 2 are ASVs of the same healthy species
+        abundances = np.array([[0.1, 0.3, 0.1, 0.1, 0.4],
+                               [0.2, 0.2, 0.4, 0.0, 0.2]])
+        included = np.array([True, True, True, True, False])
+        healthy = np.array([True, False, True, False, False])
+        non_healthy = np.array([False, True, False, True, False])
+        species = np.array(['A', 'B', 'A', 'C', 'D'])
+        aggregation, healthy_columns, non_healthy_columns = \
+            marker_columns(included, healthy, non_healthy, species)
+        npt.assert_array_equal(aggregation.toarray(), [[1, 0, 0],
+                                                       [0, 1, 0],
+                                                       [1, 0, 0],
+                                                       [0, 0, 1],
+                                                       [0, 0, 0]])
+        npt.assert_array_equal(healthy_columns, [True, False, False])
+        npt.assert_array_equal(non_healthy_columns, [False, True, True])
+
+        collapsed = np.array([[0.2, 0.3, 0.1, 0.4],
+                              [0.6, 0.2, 0.0, 0.2]])
+        expected = gmhi_dense(collapsed,
+                              np.array([True, True, True, False]),
+                              np.array([True, False, False, False]),
+                              np.array([False, True, True, False]))
+        npt.assert_allclose(gmhi_dense(abundances, included, healthy,
+                                       non_healthy, species=species),
+                            expected)
+        npt.assert_allclose(gmhi_sparse(sparse.csr_matrix(abundances),
+                                        included, healthy, non_healthy,
+                                        species=species),
+                            expected)
+
+    def test_gmhi_float32(self):
+        rng = np.random.default_rng(0)
+        counts = rng.lognormal(0, 3, (50, 20)) * (rng.random((50, 20)) > 0.3)
+        included = np.arange(20) != 19
+        healthy = np.arange(20) < 8
+        non_healthy = (np.arange(20) >= 8) & (np.arange(20) < 16)
+        expected = gmhi_dense(counts, included, healthy, non_healthy)
+        markers, totals = project_sparse(sparse.csr_matrix(counts), included,
+                                         np.arange(16), np.float32)
+        self.assertEqual(markers.dtype, np.float32)
+        self.assertEqual(totals.dtype, np.float64)
+        npt.assert_allclose(gmhi_dense(counts, included, healthy,
+                                       non_healthy, dtype=np.float32),
+                            expected, atol=1e-6)
+        npt.assert_allclose(gmhi_sparse(sparse.csr_matrix(counts), included,
+                                        healthy, non_healthy,
+                                        dtype=np.float32),
+                            expected, atol=1e-6)
+
+    def test_gmhi_sweep(self):
+        markers = np.array([[0.2, 0.3, 0.1],
+                            [0.6, 0.2, 0.0],
+                            [0.0, 0.5, 0.0005]])
+        totals = np.array([0.6, 0.8, 1.0])
+        healthy = np.array([True, False, False])
+        non_healthy = np.array([False, True, True])
+        gmhi = gmhi_sweep(markers, totals, healthy, non_healthy,
+                          mh_primes=[7, 5], mn_primes=[31],
+                          rel_threshs=[0.00001, 0.001], log_threshs=[0.1])
+        self.assertEqual(gmhi.shape, (3, 4))
+        for i, (mh_prime, rel_thresh) in enumerate([(7, 0.00001), (7, 0.001),
+                                                    (5, 0.00001), (5, 0.001)]):
+            npt.assert_allclose(gmhi[:, i], gmhi_projected(
+                markers, totals, healthy, non_healthy, mh_prime=mh_prime,
+                rel_thresh=rel_thresh, log_thresh=0.1))
+
+    def test_gmhi_rel_thresh_curve(self):
+        markers = np.array([[0.2, 0.3, 0.1],
+                            [0.3, 0.3, 0.0],
+                            [0.0, 0.0, 0.0]])
+        totals = np.array([0.6, 1.0, 1.0])
+        healthy = np.array([True, False, False])
+        non_healthy = np.array([False, True, True])
+        samples, lower, upper, gmhi = gmhi_rel_thresh_curve(
+            markers, totals, healthy, non_healthy)
+        npt.assert_array_equal(samples, [0, 0, 0, 0, 1, 1, 2])
+        npt.assert_allclose(lower, [0, 1 / 6, 1 / 3, 0.5, 0, 0.3, 0])
+        npt.assert_allclose(upper, [1 / 6, 1 / 3, 0.5, np.inf,
+                                    0.3, np.inf, np.inf])
+        for sample, rel_thresh, expected in zip(samples, upper, gmhi):
+            if np.isfinite(rel_thresh):
+                npt.assert_allclose(gmhi_projected(
+                    markers[[sample]], totals[[sample]], healthy,
+                    non_healthy, rel_thresh=rel_thresh), [expected])
+        npt.assert_array_equal(gmhi[upper == np.inf], 0)
+
+
+class TestSweepGmhi(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def test_sweep_full_taxonomy(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file).view(biom.Table)
+        sweep = _sweep_df(table, HEALTHY_SPECIES_DEFAULT,
+                          NON_HEALTHY_SPECIES_DEFAULT, mh_primes=[7, 5],
+                          rel_threshs=[0.00001, 0.01])
+        self.assertListEqual(list(sweep.columns), [
+            'mh_prime=7;mn_prime=31;rel_thresh=1e-05;log_thresh=1e-05',
+            'mh_prime=7;mn_prime=31;rel_thresh=0.01;log_thresh=1e-05',
+            'mh_prime=5;mn_prime=31;rel_thresh=1e-05;log_thresh=1e-05',
+            'mh_prime=5;mn_prime=31;rel_thresh=0.01;log_thresh=1e-05'])
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            sweep.iloc[:, 0], gmhi_exp, check_dtype=False,
+            check_index_type=False, check_series_type=False,
+            check_names=False)
+
+    def test_sweep_visualization_preview(self):
+        table = biom.load_table(self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom"))
+        sweep = _sweep_df(table, HEALTHY_SPECIES_DEFAULT,
+                          NON_HEALTHY_SPECIES_DEFAULT, mh_primes=[7, 5])
+        with tempfile.TemporaryDirectory() as output_dir:
+            _write_table_visualization(output_dir, sweep, 'Sweep',
+                                       'sweep.tsv', preview_samples=5)
+            with open(os.path.join(output_dir, 'index.html')) as fh:
+                html = fh.read()
+            tsv = pd.read_csv(os.path.join(output_dir, 'sweep.tsv'),
+                              sep='\t', index_col=0)
+        # All samples are downloadable, only the first 5 are rendered
+        self.assertEqual(len(tsv), 20)
+        self.assertIn('Showing the first 5 of 20 samples', html)
+        self.assertEqual([sample_id for sample_id in sweep.index
+                          if f'<th>{sample_id}</th>' in html],
+                         list(sweep.index[:5]))
+
+    def test_rel_thresh_curve_full_taxonomy(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file).view(biom.Table)
+        curve = _rel_thresh_curve_df(table, HEALTHY_SPECIES_DEFAULT,
+                                     NON_HEALTHY_SPECIES_DEFAULT)
+        self.assertListEqual(list(curve.columns),
+                             ['rel_thresh_from', 'rel_thresh_to', 'GMHI'])
+        default = curve[(curve.rel_thresh_from < 0.00001) &
+                        (curve.rel_thresh_to >= 0.00001)]
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            default['GMHI'], gmhi_exp, check_dtype=False,
+            check_index_type=False, check_series_type=False,
+            check_names=False)
+
+    def test_rel_thresh_curve_visualization_preview(self):
+        table = biom.load_table(self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom"))
+        curve = _rel_thresh_curve_df(table, HEALTHY_SPECIES_DEFAULT,
+                                     NON_HEALTHY_SPECIES_DEFAULT)
+        with tempfile.TemporaryDirectory() as output_dir:
+            _write_table_visualization(output_dir, curve, 'Curve',
+                                       'curve.tsv', preview_samples=3)
+            with open(os.path.join(output_dir, 'index.html')) as fh:
+                html = fh.read()
+        # Every segment of the previewed samples is rendered
+        sample_ids = list(curve.index.unique()[:3])
+        n_segments = curve.index.isin(sample_ids).sum()
+        self.assertIn('Showing the first 3 of 20 samples', html)
+        self.assertEqual(sum(html.count(f'<th>{sample_id}</th>')
+                             for sample_id in curve.index.unique()),
+                         n_segments)
+        self.assertGreater(n_segments, 3)
+
+
+class TestCache(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def test_cache_key(self):
+        key = _cache_key('uuid', ['s__a'], ['s__b'], mh_prime=7)
+        self.assertEqual(key, _cache_key('uuid', ['s__a'], ['s__b'],
+                                         mh_prime=7))
+        self.assertNotEqual(key, _cache_key('uuid', ['s__a'], ['s__b'],
+                                            mh_prime=5))
+        self.assertNotEqual(key, _cache_key('other', ['s__a'], ['s__b'],
+                                            mh_prime=7))
+        self.assertNotEqual(key, _cache_key('uuid', ['s__a'], ['s__c'],
+                                            mh_prime=7))
+
+    def test_cache_store_load(self):
+        gmhi = pd.Series([0.1, -2.5, 1 / 3], index=['001', 'S2', 'S3'],
+                         name='GMHI')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertIsNone(_cache_load(cache_dir, 'key'))
+            _cache_store(cache_dir, 'key', gmhi)
+            pdt.assert_series_equal(_cache_load(cache_dir, 'key'), gmhi)
+
+    def test_cache_evicts_least_recently_used(self):
+        gmhi = pd.Series(np.arange(40000) / 3,
+                         index=[f'S{i}' for i in range(40000)], name='GMHI')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            _cache_store(cache_dir, 'old', gmhi, max_size=2)
+            _cache_store(cache_dir, 'new', gmhi, max_size=2)
+            os.utime(os.path.join(cache_dir, 'old.gmhi.tsv'), (0, 0))
+            _cache_store(cache_dir, 'newest', gmhi, max_size=2)
+            self.assertListEqual(sorted(os.listdir(cache_dir)),
+                                 ['new.gmhi.tsv', 'newest.gmhi.tsv'])
+
+    def test_cache_evicts_label_indices(self):
+        gmhi = pd.Series(np.arange(40000) / 3,
+                         index=[f'S{i}' for i in range(40000)], name='GMHI')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            labels_fp = os.path.join(cache_dir, 'old.labels.npz')
+            with open(labels_fp, 'wb') as fh:
+                fh.write(bytes(1024 ** 2))
+            os.utime(labels_fp, (0, 0))
+            _cache_store(cache_dir, 'new', gmhi, max_size=2)
+            _cache_store(cache_dir, 'newest', gmhi, max_size=2)
+            self.assertListEqual(sorted(os.listdir(cache_dir)),
+                                 ['new.gmhi.tsv', 'newest.gmhi.tsv'])
+
+
+class TestBiomReader(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.biom_fp = self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom")
+        self.table = biom.load_table(self.biom_fp)
+
+    def test_row_sums(self):
+        with h5py.File(self.biom_fp, 'r') as biom_file:
+            matrix = biom_file['sample/matrix']
+            for rows in (None, np.array([0, 1, 2, 5, 6, 19])):
+                expected = self.table.sum(axis='sample')
+                expected = expected if rows is None else expected[rows]
+                for block_size in (1, 7, 2 ** 24):
+                    npt.assert_allclose(
+                        _row_sums(matrix, matrix['indptr'][:], rows,
+                                  block_size), expected)
+
+    def test_read_marker_projection(self):
+        n_features = self.table.shape[0]
+        included = np.arange(n_features) % 5 != 0
+        markers = np.array([1, 2, 3, 8, n_features - 1])
+        aggregation = sparse.csr_matrix(
+            (np.ones(3), ([1, 2, 8], [0, 1, 0])), shape=(n_features, 2))
+        samples = np.array([0, 3, 4, 17])
+        with h5py.File(self.biom_fp, 'r') as biom_file:
+            for projection in (markers, aggregation):
+                projected, totals = _read_marker_projection(
+                    biom_file, included, projection)
+                expected, expected_totals = project_sparse(
+                    self.table.matrix_data.T, included, projection)
+                npt.assert_allclose(projected.toarray(), expected.toarray())
+                npt.assert_allclose(totals, expected_totals)
+
+                projected, totals = _read_marker_projection(
+                    biom_file, included, projection, samples)
+                npt.assert_allclose(projected.toarray(),
+                                    expected[samples].toarray())
+                npt.assert_allclose(totals, expected_totals[samples])
+
+
+class TestScorer(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.biom_fp = self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom")
+        self.table = biom.load_table(self.biom_fp)
+        self.gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+
+    def test_panel(self):
+        scorer = GMHIScorer()
+        self.assertEqual(scorer.healthy_species, HEALTHY_SPECIES_DEFAULT)
+        self.assertEqual(len(scorer.panel), len(scorer.species))
+        for name, position in scorer.panel.items():
+            self.assertEqual(scorer.healthy[position],
+                             name in HEALTHY_SPECIES_DEFAULT)
+            self.assertEqual(scorer.non_healthy[position],
+                             name in NON_HEALTHY_SPECIES_DEFAULT)
+
+    def test_score_batches(self):
+        scorer = GMHIScorer()
+        feature_ids = self.table.ids(axis='observation')
+        abundances = self.table.matrix_data.T.tocsr()
+        # Every batch is scored on its own, with the panel compiled once
+        for start in range(0, abundances.shape[0], 4):
+            batch = abundances[start:start + 4]
+            expected = self.gmhi_exp.iloc[start:start + 4].to_numpy()
+            npt.assert_allclose(scorer.score(batch, feature_ids), expected)
+            npt.assert_allclose(scorer.score(batch.toarray(), feature_ids),
+                                expected)
+
+    def test_score_table_and_biom_file(self):
+        scorer = GMHIScorer()
+        for gmhi in (scorer.score_table(self.table),
+                     scorer.score_biom_file(self.biom_fp),
+                     scorer.score_biom_file(self.biom_fp, chunk_size=3)):
+            pdt.assert_series_equal(
+                gmhi, self.gmhi_exp, check_dtype=False,
+                check_index_type=False, check_names=False)
+
+    def test_score_missing_species(self):
+        infile = self.get_data_path("input/species/fake_MH_species.txt")
+        scorer = GMHIScorer(healthy_species_fp=infile)
+        with self.assertRaisesRegex(AssertionError,
+                                    "Could not find healthy species"):
+            scorer.score(self.table.matrix_data.T,
+                         self.table.ids(axis='observation'))
+
+
+class TestService(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def setUp(self):
+        super().setUp()
+        table = biom.load_table(self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom"))
+        self.abundances = table.to_dataframe(dense=True).T
+        self.gmhi_exp = GMHIScorer().score_table(table)
+        # Long delay, so that concurrent requests end up in one batch
+        self.server = make_server(max_delay=0.2)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        host, port = self.server.server_address[:2]
+        self.url = f'http://{host}:{port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.batcher.close()
+        super().tearDown()
+
+    def test_score(self):
+        client = GMHIClient(self.url)
+        self.assertEqual(client.health()['panels'], ['default'])
+        for start in (0, 4, 8):
+            batch = self.abundances.iloc[start:start + 4]
+            pdt.assert_series_equal(client.score(batch),
+                                    self.gmhi_exp.iloc[start:start + 4],
+                                    check_index_type=False)
+        client.close()
+
+    def test_micro_batching(self):
+        batches = [self.abundances.iloc[start:start + 3]
+                   for start in range(0, 18, 3)]
+
+        def score(batch):
+            client = GMHIClient(self.url)
+            try:
+                return client.score(batch)
+            finally:
+                client.close()
+
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(score, batches))
+        pdt.assert_series_equal(pd.concat(results), self.gmhi_exp.iloc[:18],
+                                check_index_type=False)
+        self.assertEqual(self.server.batcher.n_requests, len(batches))
+        self.assertLess(self.server.batcher.n_batches, len(batches))
+
+    def test_bad_request(self):
+        client = GMHIClient(self.url)
+        with self.assertRaisesRegex(ValueError, "samples x features"):
+            client.score([[0.5, 0.5]], ['s__A', 's__B', 's__C'])
+        with self.assertRaisesRegex(ValueError, "Unknown panel"):
+            client.score(self.abundances.iloc[:2], panel='missing')
+        client.close()
+
+    def test_malformed_request_does_not_stop_service(self):
+        client = GMHIClient(self.url)
+        with self.assertRaisesRegex(ValueError, "list of strings"):
+            client.score([[0.5, 0.5]], [['s__A'], ['s__B']])
+        # An error inside the worker fails only its batch
+        future = self.server.batcher.submit(
+            'default', np.array([[0.5, 0.5]]), [['s__A'], ['s__B']])
+        with self.assertRaises(TypeError):
+            future.result(5)
+        pdt.assert_series_equal(client.score(self.abundances.iloc[:4]),
+                                self.gmhi_exp.iloc[:4],
+                                check_index_type=False)
+        client.close()
+
+
+class TestQza(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.qza_fp = self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.qza")
+        self.gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def _rezip(self, compress_type, replace=(b'', b'')):
+        qza_fp = os.path.join(self.tmp_dir.name, 'table.qza')
+        with zipfile.ZipFile(self.qza_fp) as source, \
+                zipfile.ZipFile(qza_fp, 'w') as target:
+            for member in source.infolist():
+                data = source.read(member)
+                if member.filename.endswith('/metadata.yaml'):
+                    data = data.replace(*replace)
+                target.writestr(member.filename, data, compress_type)
+        return qza_fp
+
+    def test_gmhi_from_qza(self):
+        for qza_fp in (self.qza_fp, self._rezip(zipfile.ZIP_STORED)):
+            for chunk_size in (None, 3):
+                gmhi = gmhi_from_qza(qza_fp, chunk_size=chunk_size)
+                pdt.assert_series_equal(
+                    gmhi, self.gmhi_exp, check_dtype=False,
+                    check_index_type=False, check_names=False)
+
+    def test_gmhi_from_qza_inflated_to_file(self):
+        # Deflated payloads above the limit are inflated into a temporary
+        # file, which is removed afterwards
+        with mock.patch.object(_qza, 'INFLATE_IN_MEMORY_MAX_SIZE', 0):
+            with _qza._open_qza_biom(self.qza_fp) as (_, _, payload):
+                self.assertTrue(os.path.isfile(payload))
+            self.assertFalse(os.path.exists(payload))
+            gmhi = gmhi_from_qza(self.qza_fp)
+        pdt.assert_series_equal(gmhi, self.gmhi_exp, check_dtype=False,
+                                check_index_type=False, check_names=False)
+
+    def test_gmhi_from_qza_float32(self):
+        for chunk_size in (None, 3):
+            gmhi = gmhi_from_qza(self.qza_fp, chunk_size=chunk_size,
+                                 dtype='float32')
+            pdt.assert_series_equal(
+                gmhi, self.gmhi_exp, check_dtype=False,
+                check_index_type=False, check_names=False, atol=1e-6)
+
+    def test_gmhi_from_qzas(self):
+        qza_fps = [self.qza_fp, self._rezip(zipfile.ZIP_STORED),
+                   self.get_data_path(
+                       "input/abundances/simple_relative_abundances.qza")]
+        output_dir = os.path.join(self.tmp_dir.name, 'gmhi')
+        results = gmhi_from_qzas(qza_fps, max_concurrency=2,
+                                 output_dir=output_dir)
+        self.assertEqual(list(results), qza_fps)
+        for qza_fp, gmhi in results.items():
+            pdt.assert_series_equal(gmhi, gmhi_from_qza(qza_fp))
+        written = pd.read_csv(os.path.join(output_dir, 'table.tsv'),
+                              sep='\t', index_col=0)['GMHI']
+        pdt.assert_series_equal(written, self.gmhi_exp, check_names=False,
+                                check_index_type=False)
+
+    def test_gmhi_from_qzas_error(self):
+        with self.assertRaises(FileNotFoundError):
+            gmhi_from_qzas([self.qza_fp, 'missing.qza', self.qza_fp])
+
+    def test_gmhi_from_qza_wrong_uuid(self):
+        qza_fp = self._rezip(zipfile.ZIP_DEFLATED, (b'uuid: 6', b'uuid: 0'))
+        with self.assertRaisesRegex(ValueError, "does not match"):
+            gmhi_from_qza(qza_fp)
+
+    def test_gmhi_from_qza_wrong_type(self):
+        qza_fp = self._rezip(zipfile.ZIP_DEFLATED,
+                             (b'[Frequency]', b'[PresenceAbsence]'))
+        with self.assertRaisesRegex(ValueError, "not of the type"):
+            gmhi_from_qza(qza_fp)
+
+
+class TestIncremental(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.table = biom.load_table(self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom"))
+        self.gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.incremental_fp = os.path.join(self.tmp_dir.name, 'gmhi.tsv')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def _write(self, table, name):
+        biom_fp = os.path.join(self.tmp_dir.name, name)
+        with h5py.File(biom_fp, 'w') as biom_file:
+            table.to_hdf5(biom_file, 'test')
+        return biom_fp
+
+    def _hashes(self, table):
+        with h5py.File(self._write(table, 'hashed.biom'), 'r') as biom_file:
+            return pd.Series(_row_hashes(biom_file, block_size=3),
+                             index=table.ids())
+
+    def _modified(self, sample_id, factor):
+        table = self.table.copy()
+        table.transform(lambda data, id_, _: data * factor
+                        if id_ == sample_id else data, inplace=True)
+        return table
+
+    def test_row_hashes(self):
+        hashes = self._hashes(self.table)
+        # Independent of the order of the features
+        reordered = self.table.sort_order(
+            self.table.ids(axis='observation')[::-1], axis='observation')
+        pdt.assert_series_equal(self._hashes(reordered), hashes)
+        # Only the hash of a changed sample changes
+        sample_id = self.table.ids()[2]
+        changed = self._hashes(self._modified(sample_id, 2)) != hashes
+        self.assertEqual(list(changed[changed].index), [sample_id])
+
+    def test_score_incremental(self):
+        sample_ids = self.table.ids()
+        previous_fp = self._write(
+            self.table.filter(sample_ids[:15], inplace=False), 'previous.biom')
+        gmhi = _score_incremental(GMHIScorer(), previous_fp,
+                                  self.incremental_fp, 'parameters',
+                                  table_id='previous')
+        pdt.assert_series_equal(gmhi, self.gmhi_exp.iloc[:15],
+                                check_dtype=False, check_names=False)
+
+        # Mark stored results, samples in the file are not scored again
+        results, table_id = _load_incremental(self.incremental_fp,
+                                              'parameters')
+        self.assertEqual(table_id, 'previous')
+        results.loc[sample_ids[:2], 'GMHI'] = [42, 43]
+        _store_incremental(self.incremental_fp, 'parameters', results,
+                           table_id)
+
+        # Only new samples are scored, even if others changed, which warns
+        # as the results were calculated from another table
+        table = self._modified(sample_ids[1], 2)
+        table_fp = self._write(table, 'table.biom')
+        with self.assertWarnsRegex(UserWarning, '15 sample'):
+            gmhi = _score_incremental(GMHIScorer(), table_fp,
+                                      self.incremental_fp, 'parameters',
+                                      table_id='table')
+        gmhi_exp = self.gmhi_exp.copy()
+        gmhi_exp[sample_ids[:2]] = [42, 43]
+        pdt.assert_series_equal(gmhi, gmhi_exp, check_dtype=False,
+                                check_names=False)
+        results, table_id = _load_incremental(self.incremental_fp,
+                                              'parameters')
+        self.assertEqual(list(results.index), list(sample_ids))
+        self.assertEqual(table_id, 'previous')
+        # Hashes of the new samples are stored as well
+        hashes = self._hashes(table)
+        pdt.assert_series_equal(results['row-hash'][15:], hashes[15:],
+                                check_dtype=False, check_index_type=False,
+                                check_names=False)
+
+        # Changed samples are scored with change detection (GMHI is
+        # invariant to sample scaling, so the changed sample gets its
+        # expected GMHI back)
+        gmhi = _score_incremental(GMHIScorer(), table_fp, self.incremental_fp,
+                                  'parameters', detect_changes=True,
+                                  table_id='table')
+        gmhi_exp[sample_ids[1]] = self.gmhi_exp[sample_ids[1]]
+        pdt.assert_series_equal(gmhi, gmhi_exp, check_dtype=False,
+                                check_names=False)
+        self.assertEqual(
+            _load_incremental(self.incremental_fp, 'parameters')[1], 'table')
+        # Results checked against the same table are reused silently
+        with catch_warnings(record=True) as caught:
+            filterwarnings('always')
+            _score_incremental(GMHIScorer(), table_fp, self.incremental_fp,
+                               'parameters', table_id='table')
+        self.assertEqual(caught, [])
+
+        # Everything is scored again with other parameters
+        gmhi = _score_incremental(GMHIScorer(), table_fp, self.incremental_fp,
+                                  'other parameters')
+        pdt.assert_series_equal(gmhi, self.gmhi_exp, check_dtype=False,
+                                check_names=False)
+
+
+class TestLabelIndex(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    feature_ids = ['k__Bacteria; g__Bifidobacterium; '
+                   's__Bifidobacterium_adolescentis',
+                   'k__Bacteria; s__Clostridium_hathewayi',
+                   'k__Bacteria; s__Clostridium_hathewayi',
+                   'k__Bacteria; s__Bacteria_unclassified',
+                   'k__Viruses; s__Escherichia_virus_Lambda',
+                   's__Other_species']
+
+    def test_label_index(self):
+        label_index = _label_index(self.feature_ids, HEALTHY_SPECIES_DEFAULT,
+                                   NON_HEALTHY_SPECIES_DEFAULT)
+        self.assertListEqual(list(label_index.species), [
+            's__Bifidobacterium_adolescentis', 's__Clostridium_hathewayi',
+            's__Clostridium_hathewayi', 's__Bacteria_unclassified',
+            's__Escherichia_virus_Lambda', 's__Other_species'])
+        npt.assert_array_equal(label_index.included,
+                               [True, True, True, False, False, True])
+        npt.assert_array_equal(label_index.healthy,
+                               [True, False, False, False, False, False])
+        npt.assert_array_equal(label_index.non_healthy,
+                               [False, True, True, False, False, False])
+
+    def test_label_index_memoized_and_persisted(self):
+        _LABEL_INDEX_CACHE.clear()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            label_index = _label_index(self.feature_ids,
+                                       HEALTHY_SPECIES_DEFAULT,
+                                       NON_HEALTHY_SPECIES_DEFAULT, cache_dir)
+            self.assertIs(_label_index(self.feature_ids,
+                                       HEALTHY_SPECIES_DEFAULT,
+                                       NON_HEALTHY_SPECIES_DEFAULT),
+                          label_index)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            _LABEL_INDEX_CACHE.clear()
+            stored = _label_index(self.feature_ids, HEALTHY_SPECIES_DEFAULT,
+                                  NON_HEALTHY_SPECIES_DEFAULT, cache_dir)
+            self.assertIsNot(stored, label_index)
+            for stored_field, field in zip(stored, label_index):
+                npt.assert_array_equal(stored_field, field)
+
+    def test_taxonomy_labels(self):
+        taxonomy = pd.Series(self.feature_ids[:3],
+                             index=['asv3', 'asv1', 'asv2'])
+        npt.assert_array_equal(
+            _taxonomy_labels(['asv1', 'asv2', 'asv3', 'asv1'], taxonomy),
+            [self.feature_ids[1], self.feature_ids[2], self.feature_ids[0],
+             self.feature_ids[1]])
+
+    def test_taxonomy_labels_missing(self):
+        taxonomy = pd.Series(self.feature_ids[:2], index=['asv1', 'asv2'])
+        with self.assertRaisesRegex(ValueError, "1 feature.*asv3"):
+            _taxonomy_labels(['asv1', 'asv3'], taxonomy)
+
+
+class TestMetaphlan(TestPluginBase):
+    package = 'q2_health_index.tests'
+
+    def test_calculate_gmhi_metaphlan_minimal(self):
+        res = health_index.actions.calculate_gmhi_metaphlan(
+            metaphlan_table_fp=self.get_data_path(
+                "input/abundances/minimal_data_both_sp.txt"))
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/minimal_data_both_sp.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_calculate_gmhi_metaphlan_equals_feature_table(self):
+        gmhi = calculate_gmhi_metaphlan(self.get_data_path(
+            "input/abundances/simple_relative_abundances.txt"))
+        table = qiime2.Artifact.load(self.get_data_path(
+            "input/abundances/simple_relative_abundances.qza"))
+        gmhi_exp = health_index.actions.gmhi_predict(table=table)[0]
+        pdt.assert_series_equal(
+            gmhi, pd.to_numeric(gmhi_exp.view(pd.Series)),
+            check_index_type=False, check_names=False)
+
+    def test_calculate_gmhi_metaphlan_lineages(self):
+        # MetaPhlAn 3 layout: database comment, tax ID column, full
+        # lineages with higher rank and strain-level rows
+        table_df = pd.read_csv(self.get_data_path(
+            "input/abundances/simple_relative_abundances.txt"),
+            sep='\t', index_col=0)
+        lines = ['#mpa_v30_CHOCOPhlAn_201901',
+                 '\t'.join(['clade_name', 'NCBI_tax_id', *table_df.columns]),
+                 '\t'.join(['k__Bacteria', '2',
+                            *['100'] * table_df.shape[1]])]
+        for species, row in table_df.iterrows():
+            values = list(map(str, row))
+            lines.append('\t'.join([f'k__Bacteria|g__Genus|{species}',
+                                    '2|3|4', *values]))
+            lines.append('\t'.join([f'k__Bacteria|g__Genus|{species}|t__1',
+                                    '2|3|4', *values]))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            table_fp = os.path.join(tmp_dir, 'merged_abundance_table.txt')
+            with open(table_fp, 'w') as fh:
+                fh.write('\n'.join(lines) + '\n')
+            gmhi = calculate_gmhi_metaphlan(table_fp)
+        pdt.assert_series_equal(gmhi, calculate_gmhi_metaphlan(
+            self.get_data_path(
+                "input/abundances/simple_relative_abundances.txt")))
+
+    def test_calculate_gmhi_metaphlan_profiles(self):
+        table_fp = self.get_data_path(
+            "input/abundances/simple_relative_abundances.txt")
+        table_df = pd.read_csv(table_fp, sep='\t', index_col=0)
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            # Alternate MetaPhlAn 2 and MetaPhlAn 3 profile formats
+            for i, sample_id in enumerate(table_df.columns):
+                profile = table_df[sample_id][table_df[sample_id] > 0]
+                with open(os.path.join(profiles_dir,
+                                       f'{sample_id}_profile.txt'),
+                          'w') as fh:
+                    if i % 2:
+                        fh.write('#clade_name\tNCBI_tax_id\t'
+                                 'relative_abundance\tadditional_species\n')
+                        for species, value in profile.items():
+                            fh.write(f'k__Bacteria|{species}\t2\t{value}\t'
+                                     f'\n')
+                    else:
+                        fh.write('#SampleID\tMetaphlan2_Analysis\n')
+                        for species, value in profile.items():
+                            fh.write(f'k__Bacteria|{species}\t{value}\n')
+            with open(os.path.join(profiles_dir, 'broken_profile.txt'),
+                      'w') as fh:
+                fh.write('k__Bacteria|s__Species\tnot-a-number\n')
+
+            gmhi_exp = calculate_gmhi_metaphlan(table_fp)
+            for n_jobs in (1, 2):
+                gmhi = calculate_gmhi_metaphlan_profiles(
+                    profiles_dir, profile_suffix='_profile.txt',
+                    n_jobs=n_jobs)
+                pdt.assert_series_equal(gmhi, gmhi_exp[gmhi.index])
+                self.assertCountEqual(gmhi.index, table_df.columns)
+
+    def test_read_metaphlan_profile_duplicated_species(self):
+        panel = {'s__Alistipes_senegalensis': 0, 's__Bacteroides_sp_2_1_22': 1}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profile_fp = os.path.join(tmp_dir, 'profile.txt')
+            with open(profile_fp, 'w') as fh:
+                fh.write('k__Bacteria|s__Alistipes_senegalensis\t10\n'
+                         'k__Bacteria|s__Other_species\t30\n'
+                         'k__Bacteria|s__Alistipes_senegalensis\t20\n'
+                         'k__Bacteria|s__Bacteroides_sp_2_1_22\t40\n')
+            markers, total = _read_metaphlan_profile(profile_fp, panel)
+        # Both rows of the duplicated species are summed into its marker,
+        # consistently with the total
+        npt.assert_array_equal(markers, [30, 40])
+        self.assertEqual(total, 100)
+
+
 class TestPredictGmhi(TestPluginBase):
     package = 'q2_health_index.tests'
 
@@ -169,8 +1008,7 @@ class TestPredictGmhi(TestPluginBase):
     # Feature table with full taxonomy (real-world scenario)
 
     def test_gmhi_predict_full_taxonomy(self):
-        table_file = self.get_data_path("input/abundances"
-                                        "/full_taxonomy_mock_feature_table.qza")
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
         table = qiime2.Artifact.load(table_file)
         res = health_index.actions.gmhi_predict(table=table)
         gmhi = pd.to_numeric(res[0].view(pd.Series))
@@ -181,6 +1019,151 @@ class TestPredictGmhi(TestPluginBase):
             gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
             check_series_type=False, check_names=False)
 
+    def test_gmhi_predict_full_taxonomy_chunked(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        res = health_index.actions.gmhi_predict(table=table, chunk_size=3)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_gmhi_predict_full_taxonomy_incremental(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            incremental_fp = os.path.join(tmp_dir, 'gmhi.tsv')
+            # Scored, then read back from the results file
+            for _ in range(2):
+                res = health_index.actions.gmhi_predict(
+                    table=table, incremental_fp=incremental_fp)
+                gmhi = pd.to_numeric(res[0].view(pd.Series))
+                pdt.assert_series_equal(
+                    gmhi, gmhi_exp, check_dtype=False,
+                    check_index_type=False, check_series_type=False,
+                    check_names=False)
+
+    def test_gmhi_predict_full_taxonomy_parallel(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        res = health_index.actions.gmhi_predict(table=table, n_jobs=3)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_gmhi_predict_full_taxonomy_collapse_species(self):
+        # Species in the table are unique, so collapsing changes nothing
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        res = health_index.actions.gmhi_predict(table=table,
+                                                collapse_species=True)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_gmhi_predict_full_taxonomy_where(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        metadata = qiime2.Metadata.load(self.get_data_path(
+            "input/metadata/mock_metadata.tsv"))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        for chunk_size in (None, 3):
+            res = health_index.actions.gmhi_predict(
+                table=table, metadata=metadata, where="[Healthy]='H'",
+                chunk_size=chunk_size)
+            gmhi = pd.to_numeric(res[0].view(pd.Series))
+            pdt.assert_series_equal(
+                gmhi, gmhi_exp[gmhi_exp.index.str.startswith('H_')],
+                check_dtype=False, check_index_type=False,
+                check_series_type=False, check_names=False)
+
+    def test_gmhi_predict_taxonomy(self):
+        # Feature table with hash IDs and a separate taxonomy, as produced
+        # by DADA2 and a feature classifier
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        full_table = qiime2.Artifact.load(table_file).view(biom.Table)
+        labels = full_table.ids(axis='observation')
+        hashes = [f'asv{i}' for i in range(len(labels))]
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            full_table.update_ids(dict(zip(labels, hashes)),
+                                  axis='observation', inplace=False))
+        taxonomy = qiime2.Artifact.import_data(
+            'FeatureData[Taxonomy]',
+            pd.DataFrame({'Taxon': labels[::-1]},
+                         index=pd.Index(hashes[::-1], name='Feature ID')))
+        res = health_index.actions.gmhi_predict(table=table,
+                                                taxonomy=taxonomy)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_calculate_gmhi_full_taxonomy(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        res = health_index.actions.calculate_gmhi(table=table)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_calculate_gmhi_batch(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        full_table = qiime2.Artifact.load(table_file).view(biom.Table)
+        sample_ids = full_table.ids(axis='sample')
+        tables = [qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            full_table.filter(sample_ids[start:start + 7], inplace=False))
+            for start in (0, 7, 14)]
+        res = health_index.actions.calculate_gmhi_batch(tables=tables)
+        gmhi = pd.to_numeric(res[0].view(pd.Series))
+        gmhi_exp = pd.read_csv(
+            self.get_data_path("expected/mock_data_only_species.tsv"),
+            sep='\t', index_col=0, header=0, squeeze=True)
+        pdt.assert_series_equal(
+            gmhi, gmhi_exp, check_dtype=False, check_index_type=False,
+            check_series_type=False, check_names=False)
+
+    def test_calculate_gmhi_batch_parallel(self):
+        full_table = biom.load_table(self.get_data_path(
+            "input/abundances/full_taxonomy_mock_feature_table.biom"))
+        sample_ids = full_table.ids(axis='sample')
+        tables = [full_table.filter(sample_ids[start:start + 7],
+                                    inplace=False)
+                  for start in (0, 7, 14)]
+        pdt.assert_series_equal(
+            calculate_gmhi_batch(tables, n_jobs=2),
+            calculate_gmhi_batch([full_table]))
+
+    def test_calculate_gmhi_batch_duplicate_samples(self):
+        table_file = self.get_data_path(FULL_TAXONOMY_TABLE_FP)
+        table = qiime2.Artifact.load(table_file)
+        with self.assertRaisesRegex(ValueError, "more than one feature table"):
+            health_index.actions.calculate_gmhi_batch(tables=[table, table])
+
     # Basic examples (dataset from Gupta et al. 2020)
 
     def test_gmhi_predict_4347_final(self):